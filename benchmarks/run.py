@@ -0,0 +1,337 @@
+"""
+Benchmarks for PersistentQueue. Measures throughput and p50/p99 latency of
+put/get/peek/delete/flush on queues with different backlogs, serializers and
+storage directories, and prints the results as JSON so runs can be compared
+across commits:
+
+    python benchmarks/run.py --sizes 1MB,100MB --output results.json
+
+By default everything runs in a tmpfs (/dev/shm, if it exists) and in the
+system's temporary directory, which usually is a regular disk.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from persistent_queue import PersistentQueue  # noqa: E402
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+BATCH_SIZE = 100
+
+
+def parse_size(size):
+    size = size.strip().upper()
+    for unit, factor in UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[:-len(unit)]) * factor)
+    return int(size)
+
+
+def serializers(names):
+    available = {'pickle': (pickle.dumps, pickle.loads)}
+    if msgpack is not None:
+        available['msgpack'] = (msgpack.packb, msgpack.unpackb)
+
+    for name in names:
+        if name not in available:
+            print('Skipping {}, it is not installed'.format(name), file=sys.stderr)
+            continue
+        yield name, available[name]
+
+
+def default_dirs():
+    dirs = []
+    if os.path.isdir('/dev/shm'):
+        dirs.append('/dev/shm')
+    dirs.append(tempfile.gettempdir())
+    return dirs
+
+
+def percentile(latencies, fraction):
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    return latencies[min(int(len(latencies) * fraction), len(latencies) - 1)]
+
+
+def summarize(latencies, items, seconds):
+    return {
+        'ops': len(latencies),
+        'items': items,
+        'seconds': seconds,
+        'ops_per_sec': len(latencies) / seconds if seconds else None,
+        'items_per_sec': items / seconds if seconds else None,
+        'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+    }
+
+
+def timed(func, count):
+    """
+    Calls func count times and returns the latency of every call and the
+    total time.
+    """
+    latencies = []
+    start = time.time()
+    for _ in range(count):
+        begin = time.time()
+        func()
+        latencies.append(time.time() - begin)
+    return latencies, time.time() - start
+
+
+class Context:
+    def __init__(self, directory, serializer, durability, item_size):
+        self.directory = directory
+        self.dumps, self.loads = serializer
+        self.durability = durability
+        self.item = {'id': 0, 'data': 'x' * item_size}
+        self.item_bytes = len(self.dumps(self.item))
+        self.filenames = []
+
+    def new_queue(self, backlog=0, **kwargs):
+        """
+        Returns a new queue already holding about backlog bytes of items.
+        The backlog is written without fsyncs, the queue is then reopened
+        with the durability being measured.
+        """
+        filename = os.path.join(self.directory, 'bench-{}.queue'.format(uuid.uuid4().hex))
+        self.filenames.append(filename)
+
+        if backlog:
+            queue = PersistentQueue(filename, dumps=self.dumps, loads=self.loads, durability='os')
+            count = max(backlog // self.item_bytes, 1)
+            for start in range(0, count, 10000):
+                queue.put([self.item] * min(10000, count - start))
+            queue.sync()
+
+        return PersistentQueue(filename, dumps=self.dumps, loads=self.loads,
+                               durability=self.durability, **kwargs)
+
+    def cleanup(self):
+        for filename in self.filenames:
+            for name in (filename, filename + '.lock', filename + '.added', filename + '.removed'):
+                if os.path.isdir(name):
+                    shutil.rmtree(name)
+                elif os.path.exists(name):
+                    os.remove(name)
+        self.filenames = []
+
+
+def bench_put_single(context, backlog, ops):
+    queue = context.new_queue(backlog)
+    latencies, seconds = timed(lambda: queue.put(context.item), ops)
+    return summarize(latencies, ops, seconds)
+
+
+def bench_put_batch(context, backlog, ops):
+    queue = context.new_queue(backlog)
+    batch = [context.item] * BATCH_SIZE
+    latencies, seconds = timed(lambda: queue.put(batch), ops)
+    return summarize(latencies, ops * BATCH_SIZE, seconds)
+
+
+def bench_get(context, backlog, ops):
+    queue = context.new_queue(max(backlog, context.item_bytes * BATCH_SIZE * ops))
+    latencies, seconds = timed(lambda: queue.get(items=BATCH_SIZE), ops)
+    return summarize(latencies, ops * BATCH_SIZE, seconds)
+
+
+def bench_peek(context, backlog, ops):
+    queue = context.new_queue(max(backlog, context.item_bytes * BATCH_SIZE))
+    latencies, seconds = timed(lambda: queue.peek(items=BATCH_SIZE), ops)
+    return summarize(latencies, ops * BATCH_SIZE, seconds)
+
+
+def bench_delete(context, backlog, ops):
+    queue = context.new_queue(max(backlog, context.item_bytes * BATCH_SIZE * ops))
+    latencies, seconds = timed(lambda: queue.delete(BATCH_SIZE), ops)
+    return summarize(latencies, ops * BATCH_SIZE, seconds)
+
+
+def bench_flush(context, backlog, ops):
+    """
+    Times flush() after half of the backlog was deleted, which copies the
+    other half (or removes segments).
+    """
+    latencies = []
+    items = 0
+    for _ in range(min(ops, 3)):
+        queue = context.new_queue(backlog, flush_limit=0)
+        queue.delete(len(queue) // 2)
+        items += len(queue)
+
+        begin = time.time()
+        queue.flush()
+        latencies.append(time.time() - begin)
+        context.cleanup()
+
+    return summarize(latencies, items, sum(latencies))
+
+
+def bench_threads(context, backlog, ops, producers=4, consumers=4):
+    """
+    Runs producer and consumer threads against one queue at the same time,
+    every thread doing ops batches.
+    """
+    queue = context.new_queue(backlog)
+    batch = [context.item] * BATCH_SIZE
+    latencies = []
+    lock = threading.Lock()
+
+    def producer():
+        times, _ = timed(lambda: queue.put(batch), ops)
+        with lock:
+            latencies.extend(times)
+
+    def consumer():
+        times, _ = timed(lambda: queue.get(items=BATCH_SIZE), ops)
+        with lock:
+            latencies.extend(times)
+
+    threads = ([threading.Thread(target=producer) for _ in range(producers)]
+               + [threading.Thread(target=consumer) for _ in range(consumers)])
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, (producers + consumers) * ops * BATCH_SIZE, time.time() - start)
+
+
+def bench_wakeup(context, backlog, ops, consumers=64):
+    """
+    Blocks consumers threads on an empty queue and measures how long each
+    one takes to wake up once an item is put for it.
+    """
+    queue = context.new_queue()
+    latencies = []
+    lock = threading.Lock()
+
+    def consumer():
+        for _ in range(ops // consumers or 1):
+            put_time = queue.get()
+            with lock:
+                latencies.append(time.time() - put_time)
+
+    threads = [threading.Thread(target=consumer) for _ in range(consumers)]
+    for thread in threads:
+        thread.start()
+
+    start = time.time()
+    for _ in range(len(threads) * (ops // consumers or 1)):
+        queue.put(time.time())
+        time.sleep(0.0005)
+    for thread in threads:
+        thread.join()
+
+    return summarize(latencies, len(latencies), time.time() - start)
+
+
+BENCHMARKS = [
+    ('put_single', bench_put_single),
+    ('put_batch', bench_put_batch),
+    ('get', bench_get),
+    ('peek', bench_peek),
+    ('delete', bench_delete),
+    ('flush', bench_flush),
+    ('threads', bench_threads),
+    ('wakeup', bench_wakeup),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--dirs', default=','.join(default_dirs()),
+                        help='comma separated directories to run in (default: %(default)s)')
+    parser.add_argument('--sizes', default='1MB,100MB,1GB',
+                        help='comma separated backlogs (default: %(default)s)')
+    parser.add_argument('--serializers', default='pickle,msgpack',
+                        help='comma separated serializers (default: %(default)s)')
+    parser.add_argument('--benchmarks', default=','.join(name for name, _ in BENCHMARKS),
+                        help='comma separated benchmarks (default: %(default)s)')
+    parser.add_argument('--durability', default='always',
+                        help='durability of the measured queues (default: %(default)s)')
+    parser.add_argument('--item-size', type=int, default=512,
+                        help='bytes of data in every item (default: %(default)s)')
+    parser.add_argument('--ops', type=int, default=200,
+                        help='operations per benchmark (default: %(default)s)')
+    parser.add_argument('--output', help='file to write the JSON results to (default: stdout)')
+    args = parser.parse_args()
+
+    selected = args.benchmarks.split(',')
+    results = []
+
+    for directory in args.dirs.split(','):
+        for serializer_name, serializer in serializers(args.serializers.split(',')):
+            for size in args.sizes.split(','):
+                backlog = parse_size(size)
+                context = Context(directory, serializer, args.durability, args.item_size)
+
+                for name, benchmark in BENCHMARKS:
+                    if name not in selected:
+                        continue
+
+                    print('{} {} {} {}'.format(directory, serializer_name, size, name), file=sys.stderr)
+                    try:
+                        result = benchmark(context, backlog, args.ops)
+                    finally:
+                        context.cleanup()
+
+                    result.update({
+                        'benchmark': name,
+                        'dir': directory,
+                        'serializer': serializer_name,
+                        'backlog_bytes': backlog,
+                        'item_bytes': context.item_bytes,
+                        'durability': args.durability,
+                    })
+                    results.append(result)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
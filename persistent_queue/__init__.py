@@ -1,7 +1,15 @@
 from __future__ import absolute_import
 
+import sys
+
 from .persistent_queue import PersistentQueue
+from .priority_queue import PersistentPriorityQueue
 
 __all__ = [
     'PersistentQueue',
+    'PersistentPriorityQueue',
 ]
+
+if sys.version_info >= (3, 5):
+    from .async_queue import AsyncPersistentQueue  # noqa: F401
+    __all__.append('AsyncPersistentQueue')
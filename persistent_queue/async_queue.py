@@ -0,0 +1,386 @@
+"""
+An asyncio front-end for PersistentQueue. Disk I/O and fsyncs run in a
+dedicated executor, and waiting for items or for room happens on the event
+loop instead of in threads.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import time
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from .persistent_queue import MULTIPROCESS_WAIT_SLICE
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AsyncPersistentQueue:
+    def __init__(self, persistent_queue, executor=None):
+        """
+        Wraps a PersistentQueue so it can be used from coroutines.
+
+        persistent_queue: the PersistentQueue to wrap. It can still be used
+            directly from other threads, waiting coroutines notice changes
+            made that way too.
+        executor: where disk I/O runs. By default a dedicated single thread
+            executor is created, and shut down by close().
+        """
+        self.queue = persistent_queue
+
+        self._own_executor = executor is None
+        self._executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+        self._loop = None
+        self._added = None
+        self._removed = None
+
+        # Items of put() calls waiting to be written together
+        self._pending = []
+        self._pending_count = 0
+        self._writing = False
+
+        self.queue._listeners.append(self._listener)
+
+    def _setup(self):
+        """
+        Binds the queue to the running event loop the first time it is used.
+        """
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+            self._added = asyncio.Event()
+            self._removed = asyncio.Event()
+
+            # Other processes wake up this one through the pipes
+            if self.queue.multiprocess:
+                self._loop.add_reader(self.queue._added_fd, self._pipe_readable, self.queue._added_fd, 'put')
+                self._loop.add_reader(self.queue._removed_fd, self._pipe_readable, self.queue._removed_fd, 'get')
+
+        return self._loop
+
+    def _pipe_readable(self, fd, event):
+        self.queue._drain(fd)
+        self._changed(event)
+
+    def _listener(self, event):
+        # Called from whichever thread changed the queue
+        if self._loop is None:
+            return
+
+        try:
+            self._loop.call_soon_threadsafe(self._changed, event)
+        except RuntimeError:
+            # The event loop is closed, nobody is waiting anymore
+            pass
+
+    def _changed(self, event):
+        # Waiters hold on to the event they saw before checking the queue, so
+        # setting it and starting a new one never loses a wakeup
+        if event == 'put':
+            self._added.set()
+            self._added = asyncio.Event()
+        else:
+            self._removed.set()
+            self._removed = asyncio.Event()
+
+    def _run(self, func, *args, **kwargs):
+        return self._setup().run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _wait(self, event, deadline):
+        """
+        Waits until event is set. Returns False if deadline passed first. In
+        multiprocess mode, a blocked call in another process can take the
+        wakeup from the pipe first, so it returns True after
+        MULTIPROCESS_WAIT_SLICE seconds at the latest, for the caller to look
+        at the queue again, like PersistentQueue does.
+        """
+        timeout = None if deadline is None else max(deadline - time.time(), 0)
+        if self.queue.multiprocess and (timeout is None or timeout > MULTIPROCESS_WAIT_SLICE):
+            try:
+                await asyncio.wait_for(event.wait(), MULTIPROCESS_WAIT_SLICE)
+            except asyncio.TimeoutError:
+                pass
+            return True
+
+        if timeout is None:
+            await event.wait()
+            return True
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def _length(self):
+        # In multiprocess mode, the length is read again under the lock
+        # shared between processes
+        if self.queue.multiprocess:
+            return await self._run(len, self.queue)
+        return len(self.queue)
+
+    def qsize(self):
+        """
+        Returns the number of items in the queue. In multiprocess mode this
+        takes the file lock on the event loop thread, coroutines of this class
+        read the length in the executor instead.
+        """
+        return self.queue.qsize()
+
+    def empty(self):
+        return self.queue.empty()
+
+    def full(self):
+        return self.queue.full()
+
+    def __len__(self):
+        return len(self.queue)
+
+    async def put(self, items, timeout=None):
+        """
+        Puts items into the queue, waiting for room if the queue has a
+        maxsize, max_bytes or max_file_bytes. If timeout is given and there is
+        no room within that many seconds, raises queue.Full.
+
+        Concurrent calls are written with a single PersistentQueue.put(), so
+        they share one fsync. Once this returns the items are persisted
+        according to the queue's durability policy. The items of a call that
+        is cancelled or times out before they are written are left out.
+        """
+        if not isinstance(items, list):
+            items = [items]
+
+        if len(items) == 0:
+            return
+
+        loop = self._setup()
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            removed = self._removed
+            maxsize = self.queue.maxsize
+            if maxsize <= 0 or await self._length() + self._pending_count + len(items) <= maxsize:
+                # The items count as pending while full() runs, so concurrent
+                # calls can not all take the same room. full() runs in the
+                # executor because it takes the file lock, which is held
+                # during fsyncs.
+                self._pending_count += len(items)
+                try:
+                    full = await self._run(self.queue.full)
+                except BaseException:
+                    self._pending_count -= len(items)
+                    raise
+                if not full:
+                    break
+                self._pending_count -= len(items)
+
+            if not await self._wait(removed, deadline):
+                raise queue.Full
+
+        future = loop.create_future()
+        self._pending.append((items, future, deadline))
+
+        if not self._writing:
+            self._writing = True
+            asyncio.ensure_future(self._write_pending())
+
+        await future
+
+    async def _write_pending(self):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                try:
+                    await self._put(batch)
+                finally:
+                    self._pending_count -= sum(len(items) for items, _, _ in batch)
+                    # put() calls that counted the items twice, pending and
+                    # in the queue, look again
+                    self._changed('get')
+        finally:
+            self._writing = False
+
+    async def _put(self, batch):
+        """
+        Writes the items of batch, a list of put() calls, with a single
+        PersistentQueue.put() and resolves their futures. If they do not fit
+        together, the calls are written one by one, in order, as far as they
+        fit. Calls whose deadline passes while there is no room fail with
+        queue.Full, they are left out along with the calls that were
+        cancelled.
+        """
+        # The executor must not block on a full queue, get() needs it to make
+        # room. Waiting for the room happens on the event loop instead.
+        while True:
+            now = time.time()
+            for _, future, deadline in batch:
+                if not future.done() and deadline is not None and deadline <= now:
+                    future.set_exception(queue.Full())
+
+            batch = [call for call in batch if not call[1].done()]
+            if not batch:
+                return
+
+            items = [item for items, _, _ in batch for item in items]
+            _LOGGER.debug("Writing %s items from %s put() calls", len(items), len(batch))
+
+            removed = self._removed
+            try:
+                await self._run(self.queue.put, items, block=False)
+            except queue.Full:
+                if len(batch) > 1:
+                    batch = await self._put_each(batch)
+                    if not batch:
+                        return
+
+                deadlines = [deadline for _, _, deadline in batch]
+                await self._wait(removed, None if None in deadlines else min(deadlines))
+                continue
+            except Exception as error:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_result(None)
+            return
+
+    async def _put_each(self, batch):
+        """
+        Writes the put() calls of batch one at a time, up to the first one
+        that does not fit. Returns the calls that are left.
+        """
+        for index, (items, future, _) in enumerate(batch):
+            if future.done():
+                continue
+
+            try:
+                await self._run(self.queue.put, items, block=False)
+            except queue.Full:
+                return batch[index:]
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+
+            if not future.done():
+                future.set_result(None)
+
+        return []
+
+    async def get(self, items=1, timeout=None):
+        """
+        Removes and returns items from the queue, waiting until there are
+        enough of them. If items is greater than one, a list is returned. If
+        timeout is given and there are not enough items within that many
+        seconds, raises queue.Empty.
+
+        If a get() is cancelled while the items are being removed, they are
+        put back at the end of the queue once they are.
+        """
+        self._setup()
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            added = self._added
+            if await self._length() >= items:
+                future = self._run(self.queue.get, block=False, items=items)
+                try:
+                    # Cancelling the caller must not cancel the removal, the
+                    # items are put back once it is done instead
+                    return await asyncio.shield(future)
+                except asyncio.CancelledError:
+                    future.add_done_callback(functools.partial(self._put_back, items))
+                    raise
+                except queue.Empty:
+                    # Another consumer got there first
+                    pass
+
+            if not await self._wait(added, deadline):
+                raise queue.Empty
+
+    def _put_back(self, items, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        data = future.result() if items > 1 else [future.result()]
+        _LOGGER.debug("Putting back %s items of a cancelled get()", len(data))
+        try:
+            self._run(self._write_back, data)
+        except RuntimeError:
+            # The executor was shut down, the items must not be lost anyway
+            self._write_back(data)
+
+    def _write_back(self, data):
+        self.queue._put_back([self.queue.dumps(item) for item in data])
+
+    async def peek(self, items=1, offset=0, block=False, timeout=None):
+        """
+        Returns items from the queue without removing them. If block is true,
+        waits until there are enough of them (raising queue.Empty after
+        timeout seconds, if given).
+        """
+        self._setup()
+        deadline = None if timeout is None else time.time() + timeout
+
+        while block:
+            added = self._added
+            if await self._length() >= offset + items:
+                break
+
+            if not await self._wait(added, deadline):
+                raise queue.Empty
+
+        return await self._run(self.queue.peek, items=items, offset=offset)
+
+    async def delete(self, items=1):
+        await self._run(self.queue.delete, items)
+
+    async def flush(self):
+        await self._run(self.queue.flush)
+
+    def task_done(self, items=1):
+        self.queue.task_done(items)
+
+    async def join(self):
+        """
+        Waits until every item put into the queue was gotten and marked as
+        done with task_done().
+        """
+        self._setup()
+
+        while True:
+            removed = self._removed
+            if not self.queue._unfinished_tasks:
+                return
+
+            await removed.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        """
+        Stops listening to the queue and shuts down the executor, if it was
+        created by this object, after it put back the items of cancelled
+        get() calls. The PersistentQueue itself stays usable.
+        """
+        if self._listener in self.queue._listeners:
+            self.queue._listeners.remove(self._listener)
+
+        if self.queue.multiprocess and self._loop is not None and not self._loop.is_closed():
+            self._loop.remove_reader(self.queue._added_fd)
+            self._loop.remove_reader(self.queue._removed_fd)
+
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
@@ -0,0 +1,89 @@
+"""
+Codecs that compress the records of a PersistentQueue. The codec of a queue
+is recorded by number in the flags of its header, so the number of a codec
+must never change once files were written with it.
+"""
+
+import zlib
+
+try:
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+
+# Numbers up to this one are reserved for the codecs of this package
+BUILTIN_CODEC_IDS = 63
+MAX_CODEC_ID = 255
+
+CODECS = {}
+
+
+class Codec:
+    def __init__(self, codec_id, name, compress, decompress):
+        """
+        A way to compress records.
+
+        codec_id: the number recorded in the header of queue files, between
+            BUILTIN_CODEC_IDS + 1 and MAX_CODEC_ID for codecs registered by
+            applications.
+        name: what to pass as compression to PersistentQueue.
+        compress: takes a bytes-like object and returns the compressed bytes.
+        decompress: takes a bytes-like object and returns the original bytes.
+        """
+        self.codec_id = codec_id
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __repr__(self):
+        return 'Codec({!r}, {!r})'.format(self.codec_id, self.name)
+
+
+def register_codec(codec):
+    """
+    Makes codec available to PersistentQueue, by name and for reading files
+    that were written with it.
+    """
+    if not 0 < codec.codec_id <= MAX_CODEC_ID:
+        raise ValueError('Codec numbers must be between 1 and {}'.format(MAX_CODEC_ID))
+
+    registered = CODECS.get(codec.codec_id)
+    if registered is not None and registered.name != codec.name:
+        raise ValueError('Codec number {} is already used by {}'.format(codec.codec_id, registered.name))
+
+    CODECS[codec.codec_id] = codec
+
+
+def get_codec(compression):
+    """
+    Returns the codec for the compression option of PersistentQueue: None,
+    the name of a registered codec or a Codec.
+    """
+    if compression is None or isinstance(compression, Codec):
+        return compression
+
+    for codec in CODECS.values():
+        if codec.name == compression:
+            return codec
+
+    raise ValueError('Unknown compression {!r}, must be one of {}'.format(
+        compression, ', '.join(sorted(codec.name for codec in CODECS.values()))))
+
+
+def get_codec_by_id(codec_id, filename):
+    """
+    Returns the codec recorded in the header of filename.
+    """
+    if codec_id == 0:
+        return None
+
+    if codec_id not in CODECS:
+        raise IOError('{} is compressed with codec number {}, which is not registered'.format(filename, codec_id))
+
+    return CODECS[codec_id]
+
+
+register_codec(Codec(1, 'zlib', zlib.compress, zlib.decompress))
+
+if lzma is not None:
+    register_codec(Codec(2, 'lzma', lzma.compress, lzma.decompress))
@@ -0,0 +1,247 @@
+"""
+The in-flight table of PersistentQueue.lease(): the items of leases that were
+neither acknowledged nor given back yet. It is kept in a log next to the queue
+file, so leases survive restarts.
+
+Every entry of the log is framed with its size and a CRC32 of the size and the
+entry, like the records of the queue. An entry either adds a lease, with its deadline and the serialized
+items, or ends one. The log is rewritten with only the open leases once ended
+ones make up most of it.
+"""
+
+import collections
+import itertools
+import logging
+import os
+import struct
+import threading
+import zlib
+
+ENTRY_STRUCT = '<II'
+ENTRY_HEADER_SIZE = struct.calcsize(ENTRY_STRUCT)
+ENTRY_SIZE_STRUCT = '<I'
+ENTRY_SIZE_SIZE = struct.calcsize(ENTRY_SIZE_STRUCT)
+ENTRY_CRC_STRUCT = '<I'
+
+# Operation, lease id, deadline and number of items
+LEASE_STRUCT = '<BQdI'
+LEASE_HEADER_SIZE = struct.calcsize(LEASE_STRUCT)
+ITEM_STRUCT = '<I'
+ITEM_HEADER_SIZE = struct.calcsize(ITEM_STRUCT)
+
+OP_LEASE = 1
+OP_END = 2
+
+# The log is only rewritten once it holds this many bytes of ended leases
+REWRITE_LIMIT = 65536
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def _crc(size, data):
+    # Covering the size means a run of zeros never passes for an empty entry
+    return zlib.crc32(data, zlib.crc32(size)) & 0xffffffff
+
+
+def _parse_lease(data, start, end):
+    """
+    Returns the deadline and the items of the lease entry at start, which
+    ends at end. Raises ValueError if they do not fit in the entry.
+    """
+    payloads = []
+    offset = start + LEASE_HEADER_SIZE
+    for _ in range(struct.unpack_from(LEASE_STRUCT, data, start)[3]):
+        if offset + ITEM_HEADER_SIZE > end:
+            raise ValueError('lease entry ends in the middle of an item')
+        length = struct.unpack_from(ITEM_STRUCT, data, offset)[0]
+        offset += ITEM_HEADER_SIZE
+        if offset + length > end:
+            raise ValueError('lease entry ends in the middle of an item')
+        payloads.append(data[offset:offset + length].tobytes())
+        offset += length
+
+    return payloads
+
+
+class Lease:
+    def __init__(self, lease_id, deadline, payloads, size):
+        self.lease_id = lease_id
+        self.deadline = deadline
+        self.payloads = payloads
+
+        # Bytes taken by the lease in the log
+        self.size = size
+
+
+class LeaseTable:
+    def __init__(self, filename, sync=True):
+        """
+        Opens the in-flight table in filename, creating it if needed.
+
+        sync: fsync every change before returning.
+        """
+        self.filename = filename
+        self.sync = sync
+
+        self.leases = collections.OrderedDict()
+        self.next_id = 1
+
+        # Leases taken from the table that are still in the log
+        self._taken = {}
+
+        self._lock = threading.Lock()
+        self._size = 0
+        self._live = 0
+
+        self._load()
+        self._file = open(filename, 'ab', buffering=0)
+
+    def _load(self):
+        if not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, 'rb') as file:
+            data = memoryview(file.read())
+
+        # Anything that does not parse is what a crash left behind at the end
+        # of the log
+        pos = 0
+        while pos + ENTRY_HEADER_SIZE <= len(data):
+            size, crc = struct.unpack_from(ENTRY_STRUCT, data, pos)
+            start = pos + ENTRY_HEADER_SIZE
+            end = start + size
+            if size < LEASE_HEADER_SIZE or end > len(data):
+                break
+            if _crc(data[pos:pos + ENTRY_SIZE_SIZE], data[start:end]) != crc:
+                break
+
+            op, lease_id, deadline, _ = struct.unpack_from(LEASE_STRUCT, data, start)
+            if op == OP_LEASE:
+                try:
+                    payloads = _parse_lease(data, start, end)
+                except ValueError:
+                    break
+
+                self.leases[lease_id] = Lease(lease_id, deadline, payloads, end - pos)
+                self._live += end - pos
+            elif op == OP_END:
+                if lease_id in self.leases:
+                    self._live -= self.leases.pop(lease_id).size
+            else:
+                break
+
+            self.next_id = max(self.next_id, lease_id + 1)
+            pos = end
+
+        if pos < len(data):
+            _LOGGER.warning("Removing %s bytes of broken entries at the end of %s", len(data) - pos, self.filename)
+            with open(self.filename, 'r+b') as file:
+                file.truncate(pos)
+
+        self._size = pos
+
+    @staticmethod
+    def _entry(op, lease_id, deadline=0.0, payloads=()):
+        entry = bytearray(struct.pack(LEASE_STRUCT, op, lease_id, deadline, len(payloads)))
+        for payload in payloads:
+            entry += struct.pack(ITEM_STRUCT, len(payload))
+            entry += payload
+
+        size = struct.pack(ENTRY_SIZE_STRUCT, len(entry))
+        return size + struct.pack(ENTRY_CRC_STRUCT, _crc(size, entry)) + entry
+
+    def _append(self, entry):
+        self._file.write(entry)
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self._size += len(entry)
+
+    def add(self, deadline, payloads):
+        """
+        Records a lease of payloads until deadline and returns it.
+        """
+        payloads = [payload.tobytes() if isinstance(payload, memoryview) else payload for payload in payloads]
+
+        with self._lock:
+            lease_id = self.next_id
+            self.next_id += 1
+
+            entry = self._entry(OP_LEASE, lease_id, deadline, payloads)
+            self._append(entry)
+            lease = Lease(lease_id, deadline, payloads, len(entry))
+            self.leases[lease_id] = lease
+            self._live += len(entry)
+
+        return lease
+
+    def take(self, lease_id):
+        """
+        Removes the lease from the table, but not from the log, and returns
+        it. Returns None if there is no such lease.
+        """
+        with self._lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is not None:
+                self._taken[lease_id] = lease
+
+        return lease
+
+    def take_expired(self, now):
+        """
+        Like take(), for every lease whose deadline is at or before now.
+        """
+        with self._lock:
+            expired = [lease for lease in self.leases.values() if lease.deadline <= now]
+            for lease in expired:
+                del self.leases[lease.lease_id]
+                self._taken[lease.lease_id] = lease
+
+        return expired
+
+    def next_deadline(self):
+        """
+        Returns when the first of the leases expires, or None.
+        """
+        with self._lock:
+            return min([lease.deadline for lease in self.leases.values()] or [None])
+
+    def end(self, leases):
+        """
+        Records in the log that leases, which were taken from the table,
+        ended.
+        """
+        with self._lock:
+            self._append(b''.join(self._entry(OP_END, lease.lease_id) for lease in leases))
+            for lease in leases:
+                del self._taken[lease.lease_id]
+                self._live -= lease.size
+
+            dead = self._size - self._live
+            if dead > REWRITE_LIMIT and dead > self._live:
+                self._rewrite()
+
+    def _rewrite(self):
+        """
+        Replaces the log with one that only holds the open leases, and the
+        ones taken from the table that did not end yet.
+        """
+        _LOGGER.debug("Rewriting %s, %s of %s bytes are in use", self.filename, self._live, self._size)
+
+        temp_filename = self.filename + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            for lease in itertools.chain(self.leases.values(), self._taken.values()):
+                file.write(self._entry(OP_LEASE, lease.lease_id, lease.deadline, lease.payloads))
+            # Keeps lease ids from being handed out again. The id was never
+            # issued, ending the newest lease would drop it if it is open.
+            last = self._entry(OP_END, self.next_id)
+            file.write(last)
+            file.flush()
+            os.fsync(file.fileno())
+
+        self._file.close()
+        os.rename(temp_filename, self.filename)
+        self._file = open(self.filename, 'ab', buffering=0)
+        self._size = self._live + len(last)
+
+    def close(self):
+        self._file.close()
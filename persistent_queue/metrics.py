@@ -0,0 +1,93 @@
+"""
+Timings of the operations of a PersistentQueue. The metrics option of
+PersistentQueue takes any callable accepting a name and a duration in seconds;
+Metrics is one that keeps a histogram per name.
+
+The names are the operation and the phase, separated by a dot:
+
+    put.serialize, put.lock_wait, put.wait, put.write, put.total
+    get.lock_wait, get.wait, get.read, get.deserialize, get.total
+    peek.*, same as get
+    delete.total, lease.deserialize, lease.total
+    compact.pause
+    fsync
+
+put.wait and get.wait are the time spent blocked waiting for room or items.
+put.serialize includes framing and compression. compact.pause is how long
+flush() or compact() blocked the queue. fsync is timed wherever it happens,
+whichever operation triggered it. Queue depth and sizes are returned by
+PersistentQueue.gauges().
+"""
+
+import bisect
+import threading
+
+# Upper bounds of the buckets, in seconds: 1 microsecond to about a minute
+BUCKET_BOUNDS = [2 ** i / 1e6 for i in range(27)]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKET_BOUNDS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket holding the given fraction of
+        the timings, or the largest timing if that is smaller.
+        """
+        if not self.count:
+            return None
+
+        needed = fraction * self.count
+        seen = 0
+        for bound, count in zip(BUCKET_BOUNDS, self.counts):
+            seen += count
+            if seen >= needed:
+                return min(bound, self.max)
+
+        return self.max
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Keeps a histogram of the timings reported for every name. Pass an
+        instance as the metrics option of PersistentQueue.
+        """
+        self._lock = threading.Lock()
+        self._histograms = {}
+
+    def __call__(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        """
+        Returns the count, sum, max, p50 and p99 of the timings of every name,
+        and the count of every bucket.
+        """
+        with self._lock:
+            return {name: {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'max': histogram.max,
+                'p50': histogram.percentile(0.5),
+                'p99': histogram.percentile(0.99),
+                'buckets': list(zip(BUCKET_BOUNDS + [None], histogram.counts)),
+            } for name, histogram in self._histograms.items()}
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
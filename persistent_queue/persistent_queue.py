@@ -3,29 +3,150 @@ An implementation of a persistent queue. It is optimized for peeking at values
 and then deleting them off to top of the queue.
 """
 
+import array
+import bisect
+import collections
+import contextlib
+import errno
+import itertools
 import logging
 import os.path
 import pickle
-import shutil
+import select
 import struct
 import threading
 import time
 import uuid
+import weakref
+import zlib
 
 try:
     import queue
 except ImportError:  # pragma: no cover
     import Queue as queue
 
-LENGTH_STRUCT = 'I'
-HEADER_STRUCT = 'II'
-START_OFFSET = 4 + 4
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    ThreadPoolExecutor = None
+
+from .compression import get_codec, get_codec_by_id
+from .leases import LeaseTable
+from .storage import (FileStorage, SegmentedStorage, FORMAT_VERSION, START_OFFSET, POSITIONAL_IO,
+                      LEGACY_HEADER_STRUCT, LEGACY_START_OFFSET, CODEC_MASK, FLAG_BLOCKS,
+                      is_legacy_file, join_top, split_top)
+
+# Records are framed with the size of their payload and a CRC32 of the size
+# and the payload
+RECORD_STRUCT = '<QI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_STRUCT)
+RECORD_FIELDS_STRUCT = '<Q'
+
+# With compress_batches, records are framed in blocks: the size of the
+# (compressed) data, the number of records in it and a CRC32 of those two
+# fields and the data, then the records framed like anywhere else
+BLOCK_STRUCT = '<QII'
+BLOCK_HEADER_SIZE = struct.calcsize(BLOCK_STRUCT)
+BLOCK_FIELDS_STRUCT = '<QI'
+
+# The CRC32 is the last field of both headers
+CRC_STRUCT = '<I'
+CRC_SIZE = struct.calcsize(CRC_STRUCT)
+
+# A put() starts a new block after this many bytes of records, or this many
+# records (the most the top field of the header can skip)
+BLOCK_SIZE = 1024 * 1024
+MAX_BLOCK_ITEMS = 65535
+
+# Records of files from before the header had a version
+LEGACY_LENGTH_STRUCT = 'I'
+LEGACY_LENGTH_SIZE = struct.calcsize(LEGACY_LENGTH_STRUCT)
+
+# Legacy files are upgraded by writing this many bytes of records at a time
+UPGRADE_CHUNK_SIZE = 4 * 1024 * 1024
+
+# When a file is opened its records are walked in chunks of this size
+# (aligned to it in the file), so many small records cost a single read() call
+READ_CHUNK_SIZE = 65536
+
+# Number of records walked at a time when the offset index is built
+INDEX_SCAN_BATCH = 4096
+
+# Durability policies, see PersistentQueue.__init__
+DURABILITY_ALWAYS = 'always'
+DURABILITY_BATCH = 'batch'
+DURABILITY_INTERVAL = 'interval'
+DURABILITY_OS = 'os'
+DURABILITY_POLICIES = (DURABILITY_ALWAYS, DURABILITY_BATCH,
+                       DURABILITY_INTERVAL, DURABILITY_OS)
+
+# In multiprocess mode, blocked calls look at the queue at least this often
+# (in seconds) even if they were not woken up
+MULTIPROCESS_WAIT_SLICE = 1.0
+
+# Wakeups are drained from the pipes this many bytes at a time
+WAKEUP_READ_SIZE = 4096
+
+# Items deserialized per task on loads_executor. Smaller batches are not
+# worth handing over.
+LOADS_CHUNK_SIZE = 256
+
+# compact() copies the live data this many bytes at a time without holding
+# any lock, and only copies what is left under the locks once it is less
+COMPACT_STEP_SIZE = 4 * 1024 * 1024
+
+# How often (in seconds) the background compactor looks at the queue
+COMPACT_CHECK_INTERVAL = 1.0
+
+# Timings for metrics come from the most precise clock there is
+_clock = getattr(time, 'perf_counter', time.time)
 
 _LOGGER = logging.getLogger(__name__)
 
 
+def _loads_chunk(loads, payloads):
+    return [loads(payload) for payload in payloads]
+
+
+def _crc(fields, data):
+    """
+    Returns the CRC32 of a record or block: fields are the bytes of its
+    header before the CRC32. Since they include the size, a run of zeros
+    never passes for an empty record.
+    """
+    return zlib.crc32(data, zlib.crc32(fields)) & 0xffffffff
+
+
+def _header(fields_struct, data, *fields):
+    fields = struct.pack(fields_struct, len(data), *fields)
+    return fields + struct.pack(CRC_STRUCT, _crc(fields, data))
+
+
+def _frame(payloads, buf):
+    """
+    Appends the records of payloads to buf. Returns where each one starts.
+    """
+    starts = []
+    for payload in payloads:
+        starts.append(len(buf))
+        buf += _header(RECORD_FIELDS_STRUCT, payload)
+        buf += payload
+
+    return starts
+
+
 class PersistentQueue:
-    def __init__(self, filename, maxsize=0, dumps=pickle.dumps, loads=pickle.loads, flush_limit=1048576):
+    def __init__(self, filename, maxsize=0, dumps=pickle.dumps, loads=pickle.loads, flush_limit=1048576,
+                 durability=DURABILITY_ALWAYS, sync_interval_ms=1000, use_mmap=False, segment_size=None,
+                 multiprocess=False, loads_executor=None, compression=None, compress_batches=False,
+                 auto_compact=False, compact_ratio=0.5, compact_bytes=None, compact_idle=None,
+                 max_bytes=None, max_file_bytes=None, metrics=None, peek_cache=0,
+                 peek_cache_bytes=None):
         """
         Creates a new PersistentQueue object and underlying file.
 
@@ -34,121 +155,1013 @@ class PersistentQueue:
         dumps: the function called for persisting queue items to the file.
         loads: the function called for loading queue items from the file.
         flush_limit: below this filesize, flush() is a no-op.
+        durability: when changes are fsync'd to the underlying storage.
+            'always': every put/get/delete is fsync'd before it returns.
+            'batch': like 'always', but concurrent callers share one fsync.
+            'interval': fsync at most every sync_interval_ms, in the background.
+            'os': never fsync, leave it to the operating system.
+        sync_interval_ms: how long changes can stay unsynced in 'interval' mode.
+        use_mmap: read records through a memory map of the file instead of
+            read() calls. loads is then given memoryviews of the map instead
+            of bytes, so it must accept any bytes-like object.
+        segment_size: store the queue as a directory of segment files of about
+            this many bytes instead of a single file. flush() then removes
+            consumed segments instead of copying the queue to a new file.
+        multiprocess: allow several processes to use the file at the same time.
+            Changes are serialized with a lock file and every operation picks
+            up what the other processes did. Blocked calls are woken up
+            through named pipes next to the file. Only for single files on
+            POSIX systems.
+        loads_executor: a concurrent.futures executor that deserializes big
+            batches of peek()/get() in parallel, in chunks, once the file lock
+            is released. With a process pool, loads must be picklable.
+        compression: compress records with this codec: 'zlib', 'lzma' or the
+            name of a codec added with compression.register_codec(). The codec
+            is recorded in the file, opening a non-empty queue with another
+            one raises ValueError.
+        compress_batches: compress the records of a put() together, in blocks
+            of up to BLOCK_SIZE bytes, instead of one by one. get(items=N)
+            then decompresses one block for many records. The block that was
+            read last is kept in memory, so getting its records one at a time
+            reads and decompresses it once.
+        auto_compact: run compact() in a background thread whenever at least
+            flush_limit bytes were removed from the queue and one of the
+            following holds.
+        compact_ratio: the removed bytes make up this fraction of the file.
+        compact_bytes: this many bytes were removed.
+        compact_idle: nothing was put or gotten for this many seconds.
+        max_bytes: upperbound of the bytes taken by the items in the queue,
+            as written to the file. put() blocks like it does for maxsize.
+        max_file_bytes: upperbound of the bytes of the file, including the
+            removed items that were not compacted away yet. Only flush() or
+            compact() make room once it is reached. flush() ignores
+            flush_limit once the file is less than flush_limit bytes away from
+            it.
+        metrics: called with a name and a duration in seconds for every phase
+            of every operation, e.g. a metrics.Metrics. See the metrics module
+            for the names.
+        peek_cache: the number of deserialized items peek() keeps, so peeking
+            at the same items again neither reads nor deserializes them. The
+            same objects are returned every time, they must not be modified.
+        peek_cache_bytes: upperbound of the serialized size of the items
+            peek() keeps. Either bound enables the cache, the least recently
+            used items are dropped once one of them is reached.
         """
         if maxsize < 0:
             maxsize = 0
 
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('durability must be one of {}'.format(
+                ', '.join(DURABILITY_POLICIES)))
+
+        if multiprocess and segment_size:
+            raise ValueError('multiprocess does not support segment_size')
+
+        if multiprocess and fcntl is None:  # pragma: no cover
+            raise ValueError('multiprocess is only supported on POSIX systems')
+
         self.maxsize = maxsize
         self.filename = os.path.abspath(filename)
         self.dumps = dumps
         self.loads = loads
         self.flush_limit = flush_limit
-
-        self._file = self._open_file()
+        self.durability = durability
+        self.sync_interval_ms = sync_interval_ms
+        self.use_mmap = use_mmap
+        self.segment_size = segment_size
+        self.multiprocess = multiprocess
+        self.loads_executor = loads_executor
+        self.compression = compression
+        self.compress_batches = compress_batches
+        self.auto_compact = auto_compact
+        self.compact_ratio = compact_ratio
+        self.compact_bytes = compact_bytes
+        self.compact_idle = compact_idle
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.metrics = metrics
+        self.peek_cache = peek_cache
+        self.peek_cache_bytes = peek_cache_bytes
+
+        self._codec = get_codec(compression)
+        self._flags = self._codec.codec_id if self._codec is not None else 0
+        if compress_batches:
+            self._flags |= FLAG_BLOCKS
+
+        self._peek_cache = None
+        if peek_cache or peek_cache_bytes:
+            self._peek_cache = _PeekCache(peek_cache, peek_cache_bytes)
+
+        # With compress_batches, the position, the header and the records of
+        # the block that was read last
+        self._last_block = None
+
+        self._storage = None
         self._file_lock = threading.RLock()
         self._get_lock = threading.RLock()
-        self._get_event = threading.Event()
         self._put_lock = threading.RLock()
-        self._put_event = threading.Event()
+
+        # Blocked calls wait on these with _file_lock released, so nothing
+        # can change the queue between checking it and starting to wait
+        self._not_empty = threading.Condition(self._file_lock)
+        self._not_full = threading.Condition(self._file_lock)
 
         self._all_tasks_done = threading.Condition()
         self._unfinished_tasks = 0
 
-        self._file.seek(0, 0)
-        self._length = struct.unpack(HEADER_STRUCT[0], self._file.read(4))[0]
+        # Functions called with 'put', 'get', 'task_done' or 'compact' after
+        # the queue changed, from whichever thread changed it
+        self._listeners = []
+        self._last_activity = time.time()
+
+        self._compaction_stats = {
+            'compactions': 0,
+            'bytes_reclaimed': 0,
+            'pause_seconds': 0.0,
+            'max_pause_seconds': 0.0,
+        }
+
+        # Every commit gets a sequence number. _sync_seq is the last commit
+        # known to be on disk, which lets concurrent callers share an fsync.
+        self._sync_cond = threading.Condition()
+        self._write_seq = 0
+        self._sync_seq = 0
+        self._syncing = False
+        self._sync_timer = None
+
+        # The lock shared between processes and the pipes used to wake up
+        # blocked calls in other processes
+        self._lock_fd = None
+        self._lock_depth = 0
+        self._added_fd = None
+        self._removed_fd = None
+        if multiprocess:
+            self._lock_fd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT)
+            self._added_fd = self._open_fifo(self.filename + '.added')
+            self._removed_fd = self._open_fifo(self.filename + '.removed')
+
+        # Positions of the records in the file. The live ones start at _head,
+        # _tail is where the next record will be written.
+        self._length = 0
+        self._offsets = array.array('Q')
+        self._head = 0
+        self._tail = START_OFFSET
+
+        with self._locked():
+            if segment_size:
+                self._storage = SegmentedStorage(self.filename, segment_size, use_mmap)
+            else:
+                if is_legacy_file(self.filename):
+                    self._upgrade_legacy_file()
+                self._storage = FileStorage(self.filename, use_mmap)
+
+            self._check_format()
+            self._recover()
+
+        # Leased items that were not acknowledged yet, see lease(), and the
+        # timer that redelivers them when the next lease expires
+        self._leases = None
+        self._lease_timer = None
+        self._lease_deadline = None
+        if not multiprocess and os.path.exists(self.filename + '.inflight'):
+            self._expire_leases()
+
+        self._compactor = None
+        if auto_compact:
+            self._compactor = _Compactor(self)
+
+    def _check_format(self):
+        """
+        Makes sure the file uses the compression that was asked for. An empty
+        queue switches to it.
+        """
+        flags = self._storage.read_flags()
+        if flags == self._flags:
+            return
+
+        # Raises if the codec is unknown, even for an empty queue
+        codec = get_codec_by_id(flags & CODEC_MASK, self.filename)
+
+        if self._storage.read_header()[0] > 0:
+            raise ValueError('{} is written with compression={!r} and compress_batches={!r}'.format(
+                self.filename, codec.name if codec is not None else None, bool(flags & FLAG_BLOCKS)))
+
+        self._storage.write_flags(self._flags)
+
+    @staticmethod
+    def _open_fifo(filename):
+        try:
+            os.mkfifo(filename)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        # Opening for reading and writing never blocks and never fails for
+        # lack of a reader
+        return os.open(filename, os.O_RDWR | os.O_NONBLOCK)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """
+        Holds _file_lock and, in multiprocess mode, the lock shared between
+        processes. Whoever takes the latter first picks up what the other
+        processes did in the meantime.
+        """
+        with self._file_lock:
+            if self._lock_fd is None:
+                yield
+                return
+
+            if self._lock_depth == 0:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+
+            try:
+                if self._lock_depth == 1 and self._storage is not None:
+                    self._refresh()
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """
+        Picks up what other processes did to the queue.
+        """
+        if self._storage.refresh():
+            # The file was compacted or cleared, start over
+            self._offsets = array.array('Q')
+            self._head = 0
+            self._tail = START_OFFSET
+            self._clear_peek_cache()
+
+        self._catch_up()
 
-    def _open_file(self, mode=None):
-        mode = mode or 'r+b' if os.path.isfile(self.filename) else 'w+b'
-        file = open(self.filename, mode=mode, buffering=0)
+    def _wait(self, condition, fd, timeout):
+        """
+        Waits until the queue might have changed. Must be called inside
+        _locked(). Returns True if it waited on condition, which releases
+        _file_lock in the meantime. In multiprocess mode it returns False
+        right away, and the caller must release the locks and wait for a
+        wakeup on the pipe fd with _wait_pipe().
+        """
+        if fd is not None:
+            return False
 
-        if mode == 'w+b':
-            # write length and start pointer
-            file.write(struct.pack(HEADER_STRUCT, 0, START_OFFSET))
+        condition.wait(timeout)
+        return True
 
-        return file
+    def _wait_pipe(self, fd, timeout):
+        """
+        Waits for a wakeup on the pipe fd in multiprocess mode. Returns False
+        if timeout expired first.
+        """
+        wait = MULTIPROCESS_WAIT_SLICE if timeout is None else min(timeout, MULTIPROCESS_WAIT_SLICE)
+        if select.select([fd], [], [], wait)[0]:
+            self._drain(fd)
+            return True
+
+        return timeout is None or timeout > wait
+
+    @staticmethod
+    def _drain(fd):
+        """
+        Takes every wakeup from the pipe fd. Every put and get writes one,
+        the ones left over would end the next wait right away.
+        """
+        try:
+            while os.read(fd, WAKEUP_READ_SIZE):
+                pass
+        except OSError as error:
+            # The pipe is empty, or another waiter took the wakeups
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    @staticmethod
+    def _wake(fd):
+        try:
+            os.write(fd, b'\0')
+        except OSError as error:
+            # The pipe is full of wakeups already
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _upgrade_legacy_file(self):
+        """
+        Rewrites a file from before the header had a version in the current
+        format, streaming the records that are still in the queue to a new
+        file that then replaces the old one.
+        """
+        _LOGGER.info("Upgrading %s to format version %s", self.filename, FORMAT_VERSION)
+
+        random = str(uuid.uuid4()).replace('-', '')
+        temp_filename = self.filename + '-' + random
+        new_storage = FileStorage(temp_filename)
+
+        try:
+            with open(self.filename, 'rb', READ_CHUNK_SIZE) as legacy:
+                length, top = struct.unpack(LEGACY_HEADER_STRUCT, legacy.read(LEGACY_START_OFFSET))
+                legacy.seek(top, 0)
+
+                pos = START_OFFSET
+                payloads = []
+                chunk_size = 0
+                for _ in range(length):
+                    header = legacy.read(LEGACY_LENGTH_SIZE)
+                    if len(header) < LEGACY_LENGTH_SIZE:
+                        raise IOError('Queue file {} ends in the middle of a record'.format(self.filename))
+
+                    size = struct.unpack(LEGACY_LENGTH_STRUCT, header)[0]
+                    payload = legacy.read(size)
+                    if len(payload) < size:
+                        raise IOError('Queue file {} ends in the middle of a record'.format(self.filename))
+
+                    payloads.append(payload)
+                    chunk_size += len(payload)
+                    if chunk_size >= UPGRADE_CHUNK_SIZE:
+                        buffers = self._pack(payloads)[0]
+                        new_storage.writev(pos, buffers)
+                        pos += sum(len(buf) for buf in buffers)
+                        payloads = []
+                        chunk_size = 0
+
+                new_storage.writev(pos, self._pack(payloads)[0])
+
+            new_storage.write_length(length)
+            new_storage.write_flags(self._flags)
+            new_storage.sync()
+        except Exception:
+            new_storage.close()
+            os.remove(temp_filename)
+            raise
+
+        new_storage.close()
+        os.rename(temp_filename, self.filename)
+
+    def _notify(self, event, count=1):
+        """
+        Wakes up whoever waits for event: 'put', 'get', 'task_done' or
+        'compact'. count is the number of items that were added or removed, at
+        most that many blocked calls are woken up.
+        """
+        if event in ('put', 'get'):
+            self._last_activity = time.time()
+
+        if event == 'put':
+            with self._file_lock:
+                self._not_empty.notify(count)
+                # Pass it on to another blocked producer if there is still room
+                room = self._has_room(1, 1)
+                if room:
+                    self._not_full.notify()
+
+            if self._added_fd is not None:
+                self._wake(self._added_fd)
+                if room:
+                    self._wake(self._removed_fd)
+        elif event == 'get':
+            with self._file_lock:
+                self._not_full.notify(count)
+                # Pass it on to another blocked consumer if items are left
+                if self._length > 0:
+                    self._not_empty.notify()
+
+            if self._removed_fd is not None:
+                self._wake(self._removed_fd)
+                # Pass it on to other blocked consumers if items are left
+                if self._length > 0:
+                    self._wake(self._added_fd)
+        elif event == 'compact':
+            # Producers blocked by max_file_bytes might fit now
+            with self._file_lock:
+                self._not_full.notify_all()
+
+            if self._removed_fd is not None:
+                self._wake(self._removed_fd)
+
+        for listener in self._listeners:
+            listener(event)
 
     def _update_length(self, length):
-        current_pos = self._file.tell()
+        self._storage.write_length(length)
+        self._length = length
+
+    def _get_queue_top(self):
+        # Every commit keeps it up to date, and so does _refresh() for what
+        # other processes did
+        return self._storage.top
+
+    def _commit(self):
+        """
+        Marks the end of a change to the file and applies the durability
+        policy to it. Must be called with _file_lock held. Returns the
+        sequence number to pass to _wait_durable() once the lock is released.
+        """
+        self._write_seq += 1
+
+        if self.durability == DURABILITY_ALWAYS:
+            self._timed_sync(self._storage.sync)
+            with self._sync_cond:
+                self._sync_seq = self._write_seq
+        elif self.durability == DURABILITY_INTERVAL:
+            if self._sync_timer is None:
+                self._sync_timer = threading.Timer(self.sync_interval_ms / 1000.0,
+                                                   self._sync_from_timer)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+
+        return self._write_seq
+
+    def _timed_sync(self, sync):
+        if self.metrics is None:
+            sync()
+            return
+
+        start = _clock()
+        sync()
+        self.metrics('fsync', _clock() - start)
+
+    def _wait_durable(self, seq):
+        """
+        Blocks until the commit seq is on disk, if the durability policy
+        promises that. Must be called without holding _file_lock so that
+        other callers can add their writes to the same fsync.
+        """
+        if self.durability == DURABILITY_BATCH:
+            self._sync(seq)
+
+    def _sync(self, seq):
+        """
+        Makes sure every commit up to seq is on disk. The first caller to get
+        here does the fsync for everyone that committed before it started,
+        the rest wait for it to finish (group commit).
+        """
+        while True:
+            with self._sync_cond:
+                while self._syncing and self._sync_seq < seq:
+                    self._sync_cond.wait()
+
+                if self._sync_seq >= seq:
+                    return
+
+                self._syncing = True
+
+            synced = False
+            try:
+                with self._file_lock:
+                    sync = self._storage.prepare_sync()
+                    target = self._write_seq
+                self._timed_sync(sync)
+                synced = True
+            finally:
+                with self._sync_cond:
+                    self._syncing = False
+                    if synced:
+                        self._sync_seq = max(self._sync_seq, target)
+                    self._sync_cond.notify_all()
+
+    def _sync_from_timer(self):
+        with self._file_lock:
+            self._sync_timer = None
+            seq = self._write_seq
+
+        self._sync(seq)
+
+    def sync(self):
+        """
+        Forces every change made so far to the underlying storage. Only needed
+        with the 'interval' and 'os' durability policies.
+        """
+        with self._file_lock:
+            seq = self._write_seq
+
+        self._sync(seq)
+
+    def _pack(self, payloads):
+        """
+        Frames and compresses payloads. Returns a list of buffers to write one
+        after the other and where each record starts in them. Uncompressed
+        payloads are not copied, their headers are separate buffers. Records
+        of the same block all start where the block does.
+        """
+        if not self.compress_batches:
+            if self._codec is not None:
+                payloads = [self._codec.compress(payload) for payload in payloads]
+
+            buffers = []
+            starts = []
+            pos = 0
+            for payload in payloads:
+                starts.append(pos)
+                buffers.append(_header(RECORD_FIELDS_STRUCT, payload))
+                buffers.append(payload)
+                pos += RECORD_HEADER_SIZE + len(payload)
+
+            return buffers, starts
+
+        buf = bytearray()
+
+        starts = []
+        first = 0
+        while first < len(payloads):
+            last = first
+            size = 0
+            while last < len(payloads) and size < BLOCK_SIZE and last - first < MAX_BLOCK_ITEMS:
+                size += len(payloads[last])
+                last += 1
+
+            block = bytearray()
+            _frame(payloads[first:last], block)
+            if self._codec is not None:
+                block = self._codec.compress(bytes(block))
+
+            starts.extend(itertools.repeat(len(buf), last - first))
+            buf += _header(BLOCK_FIELDS_STRUCT, block, last - first)
+            buf += block
+            first = last
+
+        return [buf], starts
+
+    def _write_records(self, payloads, packed=None):
+        """
+        Frames payloads, writes them at the end of the queue with a single
+        call and adds the records to the offset index. packed is what _pack()
+        returns for payloads, if it was called already. If the write fails,
+        the index is left as it was.
+        """
+        buffers, starts = packed or self._pack(payloads)
+
+        self._storage.writev(self._tail, buffers)
+        self._offsets.extend(self._tail + start for start in starts)
+        self._tail += sum(len(buf) for buf in buffers)
+
+    def _scan_records(self, pos, count, recover=False):
+        """
+        Walks count records starting at pos, or the blocks holding them with
+        compress_batches, and checks them against their CRC32. The file is
+        read in large chunks, aligned to READ_CHUNK_SIZE.
+
+        Returns a list of the positions of the records and the position right
+        after the last one. A record that is cut off or corrupt raises
+        IOError. If recover is true, it ends the walk early instead when it
+        is what a crash leaves behind: it runs to the end of the file, or its
+        header is all zeros, which is what is left where the file grew but
+        the data never made it to disk.
+        """
+        if self.compress_batches:
+            header_struct, header_size = BLOCK_STRUCT, BLOCK_HEADER_SIZE
+        else:
+            header_struct, header_size = RECORD_STRUCT, RECORD_HEADER_SIZE
+
+        starts = []
+        buf = memoryview(b'')
+        base = pos  # Position of the first byte of buf
+
+        while len(starts) < count:
+            offset = pos - base
+            needed = pos + header_size
+            if len(buf) >= offset + header_size:
+                header = struct.unpack_from(header_struct, buf, offset)
+                needed += header[0]
+                if recover and not any(header):
+                    break
+                if base + len(buf) >= needed:
+                    if _crc(buf[offset:offset + header_size - CRC_SIZE],
+                            buf[offset + header_size:needed - base]) != header[-1]:
+                        if recover and needed >= self._storage.end:
+                            break
+                        raise IOError('Queue file {} has a corrupt record at {}'.format(self.filename, pos))
+
+                    starts.extend(itertools.repeat(pos, header[1] if self.compress_batches else 1))
+                    pos = needed
+                    continue
+
+            # Read at least what is missing, up to the next chunk boundary
+            read_end = needed + READ_CHUNK_SIZE - 1
+            read_end -= read_end % READ_CHUNK_SIZE
+            if needed > self._storage.end:
+                if recover:
+                    break
+                raise IOError('Queue file {} ends in the middle of a record'.format(self.filename))
+
+            base = pos
+            buf = self._storage.read(pos, min(read_end, self._storage.end))
+
+        return starts, pos
+
+    def _catch_up(self):
+        """
+        Brings the length and the offset index in line with the header: drops
+        the records that were removed and indexes the records that were
+        added since the index was last updated. When a file is opened this
+        builds the index.
+        """
+        length, top = self._storage.read_header()
+        top, skip = split_top(top)
+
+        if top >= self._tail:
+            self._offsets = array.array('Q')
+            self._head = skip
+            self._tail = top
+            self._clear_peek_cache()
+        else:
+            self._head = bisect.bisect_left(self._offsets, top) + skip
 
-        self._file.seek(0, 0)  # Go to the beginning of the file
-        self._file.write(struct.pack(HEADER_STRUCT[0], length))
-        self._file.flush()  # Probably not necessary since buffering=0
-        os.fsync(self._file.fileno())
+        remaining = length - (len(self._offsets) - self._head)
+        while remaining > 0:
+            starts, self._tail = self._scan_records(self._tail, min(remaining, INDEX_SCAN_BATCH))
+            self._offsets.extend(starts)
+            remaining -= len(starts)
 
         self._length = length
 
-        self._file.seek(current_pos, 0)
+    def _recover(self):
+        """
+        Builds the offset index from the top of the queue, checking every
+        record the header counts on the way, and repairs what a crash left
+        behind: a torn record at the end of the file is removed along with
+        everything after it, and the length is set to the number of intact
+        records. Records after the ones the header counts were never
+        committed and are removed too. A corrupt record followed by more data
+        raises IOError instead.
+        """
+        length, top = self._storage.read_header()
+        top, skip = split_top(top)
+
+        self._offsets = array.array('Q')
+        self._head = skip
+        self._tail = top
+
+        remaining = length
+        while remaining > 0:
+            count = min(remaining, INDEX_SCAN_BATCH)
+            starts, self._tail = self._scan_records(self._tail, count, recover=True)
+            self._offsets.extend(starts)
+            if len(starts) < count:
+                break
+            remaining = length - (len(self._offsets) - skip)
+
+        # The block at the top of the queue is gone
+        self._head = min(self._head, len(self._offsets))
+        self._length = len(self._offsets) - self._head
+
+        if self._tail < self._storage.end:
+            _LOGGER.warning("Removing %s bytes of broken records at the end of %s",
+                            self._storage.end - self._tail, self.filename)
+            self._storage.truncate(self._tail)
+
+        if self._length != length or self._head != skip:
+            _LOGGER.warning("Queue %s holds %s items, not %s", self.filename, self._length, length)
+            top = self._offsets[self._head] if self._head < len(self._offsets) else self._tail
+            self._storage.write_state(self._length, join_top(top, self._head - self._block_first(self._head)))
+            self._storage.sync()
+
+    def _block_first(self, index):
+        """
+        Returns the index of the first record of the block holding the record
+        at index. Without compress_batches, every record is its own block.
+        """
+        if not self.compress_batches or index >= len(self._offsets):
+            return index
+        return bisect.bisect_left(self._offsets, self._offsets[index])
 
-    def _get_queue_top(self):
-        current_pos = self._file.tell()
+    def _record_end(self, index):
+        """
+        Returns the position right after the record (or block) at index in the
+        offset index, which is where the next one starts.
+        """
+        if self.compress_batches:
+            index = bisect.bisect_right(self._offsets, self._offsets[index]) - 1
+
+        if index + 1 < len(self._offsets):
+            return self._offsets[index + 1]
+        return self._tail
+
+    def _read_records(self, first, count):
+        """
+        Reads count records, starting with the first-th item of the queue.
+        Must be called with _file_lock held.
+
+        Returns a list of memoryviews of the payloads.
+        """
+        return self._read_located(self._locate_records(first, count))
+
+    def _locate_records(self, first, count):
+        """
+        Returns where count records, starting with the first-th item of the
+        queue, are: the positions of the records, from the first record of
+        the block holding the first-th one on, how many of those positions to
+        skip, and where the last record ends. Must be called with _file_lock
+        held, _read_located() can be called without.
+        """
+        if count == 0:
+            return array.array('Q'), 0, self._tail
+
+        first += self._head
+        block_first = self._block_first(first)
+        return self._offsets[block_first:first + count], first - block_first, self._record_end(first + count - 1)
+
+    def _read_located(self, located):
+        """
+        Reads the records returned by _locate_records(). The offset index
+        tells where they are, so they are read with a single call and sliced
+        out without copying.
+
+        Returns a list of memoryviews of the payloads.
+        """
+        offsets, skip, end = located
+        if len(offsets) == skip:
+            return []
+
+        if self.compress_batches:
+            return self._read_blocks(offsets, skip, end)
+
+        start = offsets[0]
+        view = self._storage.read(start, end)
+
+        payloads = []
+        for index in range(len(offsets)):
+            offset = offsets[index] - start
+            payload_end = offsets[index + 1] - start if index + 1 < len(offsets) else end - start
+            payload = view[offset + RECORD_HEADER_SIZE:payload_end]
+            if _crc(view[offset:offset + RECORD_HEADER_SIZE - CRC_SIZE],
+                    payload) != struct.unpack_from(RECORD_STRUCT, view, offset)[1]:
+                raise IOError('Queue file {} has a corrupt record at {}'.format(self.filename, offsets[index]))
+            payloads.append(payload)
+
+        if self._codec is not None:
+            payloads = [memoryview(self._codec.decompress(payload)) for payload in payloads]
+
+        return payloads
+
+    def _read_blocks(self, offsets, skip, end):
+        """
+        Reads the records returned by _locate_records() with compress_batches.
+        When they all are in the block that was read last, only its header is
+        read again, to make sure the block is still there.
+        """
+        last = self._last_block
+        if last is not None and offsets[skip] == offsets[-1] == last[0]:
+            if self._storage.read(last[0], last[0] + BLOCK_HEADER_SIZE) == last[1]:
+                return last[2][skip:len(offsets)]
+
+        return self._unpack_blocks(self._storage.read(offsets[0], end), offsets, skip)
 
-        self._file.seek(START_OFFSET - 4, 0)  # Start at beginning of file
-        pos = struct.unpack(HEADER_STRUCT[1], self._file.read(4))[0]
+    def _unpack_blocks(self, view, offsets, skip):
+        """
+        Decompresses the blocks in view, which starts at the first of offsets,
+        and returns the records at offsets, but the first skip of them. The
+        last block is kept in _last_block, so getting its records one at a
+        time does not read and decompress it every time.
+        """
+        start = offsets[0]
+        payloads = []
+        index = skip
+        while index < len(offsets):
+            block_start = offsets[index]
+
+            header = view[block_start - start:block_start - start + BLOCK_HEADER_SIZE]
+            size, count, crc = struct.unpack_from(BLOCK_STRUCT, header)
+            data_start = block_start - start + BLOCK_HEADER_SIZE
+            data = view[data_start:data_start + size]
+            if _crc(header[:-CRC_SIZE], data) != crc:
+                raise IOError('Queue file {} has a corrupt block at {}'.format(self.filename, block_start))
+
+            if self._codec is not None:
+                data = self._codec.decompress(data)
+            else:
+                # The block outlives view, which may be part of the memory map
+                data = data.tobytes()
+            records = self._split_block(memoryview(data), count)
+            self._last_block = (block_start, header.tobytes(), records)
 
-        self._file.seek(current_pos, 0)
-        return pos
+            block_first = bisect.bisect_left(offsets, block_start)
+            block_last = bisect.bisect_right(offsets, block_start)
+            payloads.extend(records[index - block_first:block_last - block_first])
+            index = block_last
 
-    def _set_queue_top(self, top):
-        current_pos = self._file.tell()
+        return payloads
 
-        self._file.seek(START_OFFSET - 4, 0)  # Start at beginning of file
-        self._file.write(struct.pack(HEADER_STRUCT[1], top))
-        self._file.flush()  # Probably not necessary since buffering=0
-        os.fsync(self._file.fileno())
+    @staticmethod
+    def _split_block(data, count):
+        """
+        Returns the first count records of the decompressed block data.
+        """
+        records = []
+        pos = 0
+        for _ in range(count):
+            size = struct.unpack_from(RECORD_STRUCT, data, pos)[0]
+            records.append(data[pos + RECORD_HEADER_SIZE:pos + RECORD_HEADER_SIZE + size])
+            pos += RECORD_HEADER_SIZE + size
 
-        self._file.seek(current_pos, 0)
+        return records
 
-    def _peek(self, block, timeout, items, partial=False):
+    @staticmethod
+    def _record_keys(located):
         """
-        Returns a certain amount of items from the queue. If items is greater
-        than one, a list is returned.
+        Returns keys for the records returned by _locate_records(): their
+        position and their number in their block.
         """
-        def read_data():
-            length = struct.unpack(LENGTH_STRUCT, self._file.read(4))[0]
-            data = self._file.read(length)
-            return self.loads(data)
+        offsets, skip, _ = located
+        return [(offsets[index], index - bisect.bisect_left(offsets, offsets[index]))
+                for index in range(skip, len(offsets))]
+
+    def _clear_peek_cache(self):
+        if self._peek_cache is not None:
+            self._peek_cache.clear()
+
+    def _advance(self, count):
+        """
+        Moves the top of the queue count items forward. Must be called with
+        _file_lock held.
+        """
+        if self._peek_cache is not None:
+            self._peek_cache.discard(self._record_keys(self._locate_records(0, count)))
+
+        self._head += count
+
+        # The index keeps the whole block of the top of the queue
+        first = self._block_first(self._head)
+        top = self._offsets[self._head] if self._head < len(self._offsets) else self._tail
+        self._length -= count
+        self._storage.write_state(self._length, join_top(top, self._head - first))
+
+        # Drop the dead part of the index once it makes up most of it
+        if first > INDEX_SCAN_BATCH and first * 2 > len(self._offsets):
+            del self._offsets[:first]
+            self._head -= first
+
+    def _parallel_loads(self, count):
+        return self.loads_executor is not None and count > LOADS_CHUNK_SIZE
+
+    def _deserialize(self, payloads, name=None):
+        """
+        Runs loads on every payload, in chunks on loads_executor if there are
+        enough of them. The order is preserved. With metrics, the time it
+        takes is recorded as name.deserialize.
+        """
+        if self.metrics is not None and name is not None:
+            start = _clock()
+            data = self._deserialize(payloads)
+            self.metrics(name + '.deserialize', _clock() - start)
+            return data
+
+        if not self.use_mmap:
+            # Only use_mmap hands loads memoryviews, it might not take them
+            payloads = [bytes(payload) for payload in payloads]
+
+        if not self._parallel_loads(len(payloads)):
+            return [self.loads(payload) for payload in payloads]
+
+        chunks = [payloads[i:i + LOADS_CHUNK_SIZE] for i in range(0, len(payloads), LOADS_CHUNK_SIZE)]
+        if self.use_mmap and not isinstance(self.loads_executor, ThreadPoolExecutor):
+            # memoryviews can not be sent to other processes
+            chunks = [[bytes(payload) for payload in chunk] for chunk in chunks]
+
+        results = self.loads_executor.map(_loads_chunk, [self.loads] * len(chunks), chunks)
+        return [item for chunk in results for item in chunk]
+
+    def _timed_read(self, located, name, start):
+        """
+        Reads the records returned by _locate_records(). With metrics, the
+        time since start is recorded as name.read.
+        """
+        payloads = self._read_located(located)
+        if self.metrics is not None:
+            self.metrics(name + '.read', _clock() - start)
+        return payloads
+
+    def _peek(self, block, timeout, items, partial=False, offset=0, remove=False, raw=False, start=None):
+        """
+        Returns a certain amount of items from the queue, skipping the first
+        offset items. If items is greater than one, a list is returned.
+
+        If remove is true, the items are also removed from the queue. The
+        sequence number of that commit is returned along with the items.
+
+        If raw is true, memoryviews of the payloads are returned instead of
+        deserialized items.
+
+        start is when the caller started, if metrics are enabled.
+        """
+        metrics = self.metrics
+        name = 'get' if remove else 'peek'
+        locking = start if start is not None else _clock()
+        reading = None
 
         _LOGGER.debug("Peeking %s items", items)
 
         # Ignore requests for zero items
         if items == 0:
             _LOGGER.debug("Returning empty list")
-            return [], self._file.tell()
-
-        if block:
-            if timeout is not None:
-                target = time.time() + timeout
-            while self._length < items:
-                if self._put_event.wait(timeout) is False:
-                    # Nothing was added to the queue and timeout expired
-                    # This will never happen if timeout is None
-                    raise queue.Empty
-                self._put_event.clear()
-
-                # Something was added to the queue
-                # Update timeout, if necessary
-                if timeout is not None:  # pragma: no cover
-                    timeout = target - time.time()
+            return [], None
+
+        if block and timeout is not None:
+            target = time.time() + timeout
+
+        # Blocked calls wait without _get_lock, so all of them wait on
+        # _not_empty and their timeouts hold. Whoever finds the items keeps
+        # it until they are read (and removed).
+        holding = False
+        try:
+            while True:
+                self._get_lock.acquire()
+                holding = True
+                with self._locked():
+                    if metrics is not None:
+                        reading = _clock()
+                        metrics(name + '.lock_wait', reading - locking)
+
+                    if self._length >= offset + items or (partial and not block):
+                        total_items = max(min(items, self._length - offset), 0)
+                        located = self._locate_records(offset, total_items)
+
+                        data = keys = None
+                        if self._peek_cache is not None and not remove and not raw:
+                            keys = self._record_keys(located)
+                            data = self._peek_cache.get(keys)
+
+                        # _get_lock is held, so nothing else in this process
+                        # can remove or move the records while they are read and
+                        # deserialized without the file lock, and puts can go on
+                        # in the meantime. Other processes could remove them.
+                        # Without positional I/O reads move the file position, so
+                        # they must not run next to writes.
+                        payloads = None
+                        if data is None and (not POSITIONAL_IO or self.multiprocess):
+                            payloads = self._timed_read(located, name, reading)
+                        unlocked = data is None and not self.multiprocess and (
+                            payloads is None or (not raw and self._parallel_loads(total_items)))
+
+                        seq = None
+                        if data is None and not unlocked:
+                            data = payloads if raw else self._deserialize(payloads, name)
+                            if keys is not None:
+                                self._peek_cache.put(keys, data, payloads)
+                            if remove:
+                                self._advance(total_items)
+                                seq = self._commit()
+                        break
+
+                    self._get_lock.release()
+                    holding = False
+
+                    if not block:
+                        raise queue.Empty
 
-        elif not partial and self._length < items:
-            raise queue.Empty
-
-        with self._file_lock:
-            self._file.seek(self._get_queue_top(), 0)  # Beginning of data
-            total_items = self._length if items > self._length else items
-            data = [read_data() for i in range(total_items)]
-            queue_top = self._file.tell()
+                    if timeout is not None:
+                        timeout = target - time.time()
+                        if timeout <= 0:
+                            raise queue.Empty
+
+                    # Wait for something to be added to the queue
+                    if self._wait(self._not_empty, self._added_fd, timeout):
+                        if metrics is not None:
+                            locking = _clock()
+                            metrics(name + '.wait', locking - reading)
+                        continue
+
+                if not self._wait_pipe(self._added_fd, timeout):
+                    raise queue.Empty
+                if metrics is not None:
+                    locking = _clock()
+                    metrics(name + '.wait', locking - reading)
+
+            if unlocked:
+                if payloads is None:
+                    payloads = self._timed_read(located, name, _clock() if metrics is not None else None)
+                data = payloads if raw else self._deserialize(payloads, name)
+                if keys is not None:
+                    self._peek_cache.put(keys, data, payloads)
+                if remove:
+                    with self._locked():
+                        self._advance(total_items)
+                        seq = self._commit()
+        finally:
+            if holding:
+                self._get_lock.release()
 
         if items == 1:
             if len(data) == 0:
                 _LOGGER.debug("No items to peek at so returning None")
-                return None, queue_top
+                return None, seq
             else:
                 _LOGGER.debug("Returning data from peek")
-                return data[0], queue_top
+                return data[0], seq
         else:
             _LOGGER.debug("Returning data from peek")
-            return data, queue_top
+            return data, seq
+
+    def _get_length(self):
+        """
+        Returns the length of the queue, reading it again in multiprocess mode.
+        """
+        if self.multiprocess:
+            with self._locked():
+                return self._length
+
+        return self._length
 
     def qsize(self):
         """
@@ -158,7 +1171,7 @@ class PersistentQueue:
         guarantee that a subsequent get() will not block, nor will qsize() <
         maxsize guarantee that put() will not block.
         """
-        return self._length
+        return self._get_length()
 
     def empty(self):
         """
@@ -169,7 +1182,30 @@ class PersistentQueue:
         block. Similarly, if empty() returns False it doesn't guarantee that a
         subsequent call to get() will not block.
         """
-        return self._length == 0
+        return self._get_length() == 0
+
+    def _bytes(self):
+        """
+        Returns the bytes taken by the items in the queue and by the whole
+        file, without the header. Must be called with _file_lock held.
+        """
+        top = self._offsets[self._head] if self._head < len(self._offsets) else self._tail
+        return self._tail - top, self._tail - self._storage.start
+
+    def _has_room(self, count, size):
+        """
+        Returns whether count items of size bytes fit into the queue. Items
+        that would not fit into an empty queue are let in once it is empty.
+        Must be called with _file_lock held.
+        """
+        if self.maxsize > 0 and self._length + count > self.maxsize:
+            return False
+
+        live, total = self._bytes()
+        if self.max_bytes and live and live + size > self.max_bytes:
+            return False
+
+        return not (self.max_file_bytes and total and total + size > self.max_file_bytes)
 
     def full(self):
         """
@@ -180,13 +1216,15 @@ class PersistentQueue:
         block. Similarly, if full() returns False it doesn't guarantee that a
         subsequent call to put() will not block.
         """
-        return self.maxsize > 0 and self._length >= self.maxsize
+        with self._locked():
+            return not self._has_room(1, 1)
 
     def put(self, items, block=True, timeout=None):
         """
         Provides compatibility with stdlib Queue objects.
         When this function returns, all items are guaranteed to be persisted
-        into the file and the underlying storage.
+        into the file, and into the underlying storage unless the durability
+        policy is 'interval' or 'os'.
 
         items: single object, or a list of objects
 
@@ -198,13 +1236,6 @@ class PersistentQueue:
         slot is immediately available, else raise the Full exception (timeout
         is ignored in that case).
         """
-        def write_data(item):
-            data = self.dumps(item)
-            self._file.write(struct.pack(LENGTH_STRUCT, len(data)))
-            self._file.write(data)
-            self._file.flush()  # Probably not necessary since buffering=0
-            os.fsync(self._file.fileno())
-
         if not isinstance(items, list):
             items = [items]
 
@@ -215,37 +1246,109 @@ class PersistentQueue:
             _LOGGER.debug("Putting zero items, ignoring request")
             return
 
-        with self._put_lock:
-            if self.maxsize > 0:
-                if block:
+        start = _clock() if self.metrics is not None else None
+        self._put([self.dumps(i) for i in items], block, timeout, start)
+        _LOGGER.debug("Done putting data")
+
+    def put_bytes(self, buffers, block=True, timeout=None):
+        """
+        Like put(), for items that are serialized already: they are written
+        as they are, without dumps(), and can be read back with get_bytes() or
+        peek_bytes(), or with get() and peek() if loads() understands them.
+
+        buffers: a bytes-like object (anything supporting the buffer
+            protocol), or a list of them. They are written with writev()
+            where available, without being copied.
+        """
+        if not isinstance(buffers, list):
+            buffers = [buffers]
+
+        _LOGGER.debug("Putting %s buffers", len(buffers))
+
+        if len(buffers) == 0:
+            _LOGGER.debug("Putting zero buffers, ignoring request")
+            return
+
+        start = _clock() if self.metrics is not None else None
+        payloads = []
+        for buf in buffers:
+            view = memoryview(buf)
+            if view.ndim != 1 or view.itemsize != 1:
+                view = view.cast('B')
+            payloads.append(view)
+
+        self._put(payloads, block, timeout, start)
+        _LOGGER.debug("Done putting data")
+
+    def _put(self, payloads, block, timeout, start=None):
+        """
+        Writes payloads, which were serialized starting at time start if
+        metrics are enabled.
+        """
+        metrics = self.metrics
+        packed = self._pack(payloads)
+
+        if metrics is not None:
+            locking = _clock()
+            metrics('put.serialize', locking - start)
+
+        if block and timeout is not None:
+            target = time.time() + timeout
+
+        # Blocked calls wait without _put_lock, so all of them wait on
+        # _not_full and their timeouts hold
+        holding = False
+        try:
+            while True:
+                self._put_lock.acquire()
+                holding = True
+                with self._locked():
+                    if metrics is not None:
+                        writing = _clock()
+                        metrics('put.lock_wait', writing - locking)
+
+                    if self._has_room(len(payloads), sum(len(buf) for buf in packed[0])):
+                        self._write_records(payloads, packed)
+
+                        self._update_length(self._length + len(payloads))
+                        self._unfinished_tasks += len(payloads)
+                        if metrics is not None:
+                            metrics('put.write', _clock() - writing)
+                        seq = self._commit()
+                        break
+
+                    self._put_lock.release()
+                    holding = False
+
+                    if not block:
+                        raise queue.Full
+
                     if timeout is not None:
-                        target = time.time() + timeout
-                    while self._length + len(items) > self.maxsize:
-                        if self._get_event.wait(timeout) is False:
-                            # Nothing was removed from the queue and timeout expired
-                            # This will never happen if timeout is None
+                        timeout = target - time.time()
+                        if timeout <= 0:
                             raise queue.Full
-                        self._get_event.clear()
-
-                        # Something was removed from the queue
-                        # Update timeout, if necessary
-                        if timeout is not None:  # pragma: no cover
-                            timeout = target - time.time()
-                else:
-                    if self._length + len(items) > self.maxsize:
-                        raise queue.Full
 
-            with self._file_lock:
-                self._file.seek(0, 2)  # Go to end of file
+                    # Wait for something to be removed from the queue
+                    if self._wait(self._not_full, self._removed_fd, timeout):
+                        if metrics is not None:
+                            locking = _clock()
+                            metrics('put.wait', locking - writing)
+                        continue
 
-                for i in items:
-                    write_data(i)
+                if not self._wait_pipe(self._removed_fd, timeout):
+                    raise queue.Full
+                if metrics is not None:
+                    locking = _clock()
+                    metrics('put.wait', locking - writing)
+        finally:
+            if holding:
+                self._put_lock.release()
 
-                self._update_length(self._length + len(items))
-                self._unfinished_tasks += len(items)
+        self._wait_durable(seq)
+        self._notify('put', len(payloads))
 
-            self._put_event.set()
-            _LOGGER.debug("Done putting data")
+        if metrics is not None:
+            metrics('put.total', _clock() - start)
 
     def put_nowait(self, items):
         """
@@ -270,27 +1373,32 @@ class PersistentQueue:
         ignored in that case).
         """
         _LOGGER.debug("Getting %s items", items)
+        return self._get(block, timeout, items)
+
+    def get_bytes(self, block=True, timeout=None, items=1):
+        """
+        Like get(), but returns memoryviews of the serialized items, without
+        calling loads(). See put_bytes().
+        """
+        _LOGGER.debug("Getting %s buffers", items)
+        return self._get(block, timeout, items, raw=True)
 
+    def _get(self, block, timeout, items, raw=False):
         # Ignore requests for zero items
         if items == 0:
             _LOGGER.debug("Returning empty list")
             return []
 
-        with self._get_lock:
-            data, queue_top = self._peek(block, timeout, items)
+        start = _clock() if self.metrics is not None else None
+        data, seq = self._peek(block, timeout, items, remove=True, raw=raw, start=start)
 
-            with self._file_lock:
-                self._set_queue_top(queue_top)
+        self._wait_durable(seq)
+        self._notify('get', items)
 
-                if isinstance(data, list):
-                    if len(data) > 0:
-                        self._update_length(self._length - len(data))
-                elif data is not None:
-                    self._update_length(self._length - 1)
-
-                self._get_event.set()
-                _LOGGER.debug("Returning data from get")
-                return data
+        if start is not None:
+            self.metrics('get.total', _clock() - start)
+        _LOGGER.debug("Returning data from get")
+        return data
 
     def get_nowait(self):
         """
@@ -327,6 +1435,8 @@ class PersistentQueue:
                 self._all_tasks_done.notify_all()
             self._unfinished_tasks = unfinished
 
+        self._notify('task_done')
+
     def join(self):
         """
         Provides compatibility with stdlib Queue objects.
@@ -343,36 +1453,79 @@ class PersistentQueue:
             while self._unfinished_tasks:
                 self._all_tasks_done.wait()
 
-    def peek(self, block=False, timeout=None, items=1):
+    def peek(self, block=False, timeout=None, items=1, offset=0):
         """
         Peeks into the queue and returns items without removing them.
+
+        offset: number of items at the top of the queue to skip.
+        """
+        return self._peek_timed(block, timeout, items, offset)
+
+    def peek_bytes(self, block=False, timeout=None, items=1, offset=0):
         """
-        with self._get_lock:
-            return self._peek(block, timeout, items, partial=True)[0]
+        Like peek(), but returns memoryviews of the serialized items, without
+        calling loads(). See put_bytes().
+        """
+        return self._peek_timed(block, timeout, items, offset, raw=True)
+
+    def _peek_timed(self, block, timeout, items, offset, raw=False):
+        start = _clock() if self.metrics is not None else None
+        data = self._peek(block, timeout, items, partial=True, offset=offset, raw=raw, start=start)[0]
+
+        if start is not None:
+            self.metrics('peek.total', _clock() - start)
+        return data
 
     def clear(self):
         """
         Removes all elements from queue, by truncating the file and reloading.
         """
         _LOGGER.debug("Clearing the queue")
-        with self._file_lock, self._get_lock:
-            self._file.close()
-            self._file = self._open_file(mode='w+b')
+        with self._get_lock, self._locked():
+            removed = self._length
+            self._storage.clear()
+            self._storage.write_flags(self._flags)
             self._length = 0
+            self._offsets = array.array('Q')
+            self._head = 0
+            self._tail = START_OFFSET
+            self._clear_peek_cache()
             _LOGGER.debug("The queue has been cleared")
 
+        self._notify('get', removed)
+
     def copy(self, new_filename):
         """
         Copies a queue to a new queue by duplicating the underlying file.
 
         new_filename: must be a full path to the new file.
         """
-        shutil.copy2(self.filename, new_filename)
+        with self._locked():
+            self._storage.sync()
+            self._storage.copy(new_filename)
+
         return PersistentQueue(maxsize=self.maxsize,
                                filename=new_filename,
                                dumps=self.dumps,
                                loads=self.loads,
-                               flush_limit=self.flush_limit)
+                               flush_limit=self.flush_limit,
+                               durability=self.durability,
+                               sync_interval_ms=self.sync_interval_ms,
+                               use_mmap=self.use_mmap,
+                               segment_size=self.segment_size,
+                               multiprocess=self.multiprocess,
+                               loads_executor=self.loads_executor,
+                               compression=self.compression,
+                               compress_batches=self.compress_batches,
+                               auto_compact=self.auto_compact,
+                               compact_ratio=self.compact_ratio,
+                               compact_bytes=self.compact_bytes,
+                               compact_idle=self.compact_idle,
+                               max_bytes=self.max_bytes,
+                               max_file_bytes=self.max_file_bytes,
+                               metrics=self.metrics,
+                               peek_cache=self.peek_cache,
+                               peek_cache_bytes=self.peek_cache_bytes)
 
     def flush(self):
         """
@@ -380,59 +1533,157 @@ class PersistentQueue:
         """
         _LOGGER.debug("Flushing the queue")
 
-        with self._file_lock:
-            pos = self._get_queue_top()
+        with self._locked():
+            pos = split_top(self._get_queue_top())[0]
+            # Below flush_limit, producers could stay blocked by max_file_bytes
+            near_limit = self.max_file_bytes and self._bytes()[1] + self.flush_limit > self.max_file_bytes
 
-        if pos < self.flush_limit:
-            # Ignore if the file isn't big enough -- it's not worth it
+        if pos - self._storage.start < self.flush_limit and not near_limit:
+            # Ignore if there isn't enough to reclaim -- it's not worth it
             _LOGGER.debug("Ignoring flush because we haven't met the limit")
             return
 
-        # Make a new file
-        random = str(uuid.uuid4()).replace('-', '')
-        temp_filename = self.filename + '-' + random
-        new_file = open(temp_filename, mode='w+b', buffering=0)
+        self._compact_locked()
+        _LOGGER.debug("Finished flushing the queue")
 
+    def _compact_locked(self):
+        """
+        Compacts the storage in one go, holding the locks the whole time.
+        """
         # From this point on, the file can not change
-        with self._file_lock, self._get_lock:
-            # Make sure everything is to disk
-            self._file.flush()
-            os.fsync(self._file.fileno())
+        with self._get_lock, self._locked():
+            begin = time.time()
+            size = self._storage.end - self._storage.start
 
             start = self._get_queue_top()  # Get it again in case it changed
-            self._file.seek(0, 2)  # Go to end of file
-            end = self._file.tell()
-
-            _LOGGER.debug("Writing data to new file")
-            # Copy over meta data
-            new_file.write(struct.pack(HEADER_STRUCT,
-                                       self._length,
-                                       START_OFFSET))
-
-            # Copy over data
-            # Do it in chunks so we aren't loading tons of data into memory
-            self._file.seek(start, 0)
-            bytes_read = 0
-            chunk_size = 4096
-            while bytes_read < end - start:
-                bytes_read += chunk_size
-                new_file.write(self._file.read(bytes_read))
-
-            new_file.flush()  # Probably not necessary since buffering=0
-            os.fsync(new_file.fileno())
-            new_file.close()
-            self._file.close()
-
-            # So far everything above this point has been safe. If something
-            # crashed, the data would still be preserved. Now we are entering
-            # the danger zone.
-
-            _LOGGER.debug("Replacing old file with new file")
-            os.remove(self.filename)
-            os.rename(temp_filename, self.filename)
-            self._file = self._open_file()
-
-            _LOGGER.debug("Finished flushing the queue")
+            shift = self._storage.compact(start, self._length)
+            self._compacted(shift, size, begin)
+
+        self._notify('compact')
+
+    def compact(self):
+        """
+        Removes elements that have been deleted or gotten from the queue, like
+        flush() but regardless of flush_limit. The data left is copied in
+        steps of COMPACT_STEP_SIZE without holding any lock, so the queue is
+        only blocked while the data added in the meantime is copied.
+        """
+        _LOGGER.debug("Compacting the queue")
+
+        with self._locked():
+            compaction = self._storage.start_compaction(split_top(self._get_queue_top())[0])
+
+        if compaction is None:
+            # Nothing needs to be copied
+            self._compact_locked()
+            return
+
+        try:
+            while True:
+                with self._locked():
+                    end = self._storage.end
+                if end - compaction.copied <= COMPACT_STEP_SIZE:
+                    break
+                compaction.copy(end, COMPACT_STEP_SIZE)
+        except Exception:
+            compaction.abort()
+            raise
+
+        with self._get_lock, self._locked():
+            begin = time.time()
+            size = self._storage.end - self._storage.start
+
+            shift = compaction.finish(self._get_queue_top(), self._length)
+            if shift is None:
+                _LOGGER.debug("The file was replaced while compacting it")
+                return
+            self._compacted(shift, size, begin)
+
+        self._notify('compact')
+        _LOGGER.debug("Finished compacting the queue")
+
+    def _compacted(self, shift, size, begin):
+        """
+        Updates the offset index and the statistics after the storage was
+        compacted, from size bytes, starting at time begin.
+        """
+        if shift:
+            # Everything moved closer to the beginning of the file
+            first = self._block_first(self._head)
+            self._offsets = array.array('Q', (offset - shift for offset in self._offsets[first:]))
+            self._head -= first
+            self._tail -= shift
+            self._clear_peek_cache()
+
+        # Compacting fsyncs everything, so every commit so far is on disk
+        with self._sync_cond:
+            self._sync_seq = self._write_seq
+
+        pause = time.time() - begin
+        if self.metrics is not None:
+            self.metrics('compact.pause', pause)
+
+        stats = self._compaction_stats
+        stats['compactions'] += 1
+        stats['bytes_reclaimed'] += size - (self._storage.end - self._storage.start)
+        stats['pause_seconds'] += pause
+        stats['max_pause_seconds'] = max(stats['max_pause_seconds'], pause)
+
+    def _should_compact(self):
+        """
+        Returns True if the auto_compact policy says it is time to compact.
+        """
+        with self._locked():
+            removed = self._storage.reclaimable(self._get_queue_top())
+            size = self._storage.end - self._storage.start
+
+        if removed <= 0 or removed < self.flush_limit:
+            return False
+
+        if self.compact_bytes is not None and removed >= self.compact_bytes:
+            return True
+
+        if self.compact_ratio is not None and removed >= size * self.compact_ratio:
+            return True
+
+        return self.compact_idle is not None and time.time() - self._last_activity >= self.compact_idle
+
+    def gauges(self):
+        """
+        Returns the number of items in the queue, the bytes they take, the
+        bytes of removed items that were not compacted away yet and the bytes
+        of the whole file (without the header).
+        """
+        with self._locked():
+            live, total = self._bytes()
+            return {
+                'depth': self._length,
+                'live_bytes': live,
+                'dead_bytes': total - live,
+                'file_bytes': total,
+            }
+
+    def compaction_stats(self):
+        """
+        Returns how many times the queue was compacted by flush() or
+        compact(), how many bytes that reclaimed, how long the queue was
+        blocked for, in total and at most, and how many bytes were copied in
+        how many seconds.
+        """
+        stats = dict(self._compaction_stats)
+        stats['bytes_copied'] = self._storage.bytes_copied
+        stats['copy_seconds'] = self._storage.copy_seconds
+        return stats
+
+    def peek_cache_stats(self):
+        """
+        Returns how many peek() calls were served by the peek cache and how
+        many were not, how many items it dropped for lack of room, and how
+        many items and bytes it holds.
+        """
+        if self._peek_cache is None:
+            return {'hits': 0, 'misses': 0, 'evictions': 0, 'items': 0, 'bytes': 0}
+        return self._peek_cache.stats()
 
     def delete(self, items=1):
         """
@@ -440,10 +1691,6 @@ class PersistentQueue:
 
         items: number of how many items will be deleted
         """
-        def read_length():
-            length = struct.unpack(LENGTH_STRUCT, self._file.read(4))[0]
-            self._file.seek(length, 1)
-
         _LOGGER.debug("Deleting %s items", items)
 
         # Ignore requests for zero items
@@ -451,20 +1698,516 @@ class PersistentQueue:
             _LOGGER.debug("Ignoring request to delete")
             return
 
-        with self._file_lock, self._get_lock:
-            self._file.seek(self._get_queue_top(), 0)  # Beginning of data
+        start = _clock() if self.metrics is not None else None
+        with self._get_lock, self._locked():
             total_items = self._length if items > self._length else items
+            self._advance(total_items)
+            seq = self._commit()
 
-            for _ in range(total_items):
-                read_length()
-
-            self._set_queue_top(self._file.tell())
-            self._update_length(self._length - total_items)
+        self._wait_durable(seq)
+        self._notify('get', total_items)
 
+        if start is not None:
+            self.metrics('delete.total', _clock() - start)
         _LOGGER.debug("Done deleting data")
 
+    def _lease_table(self):
+        if self.multiprocess:
+            raise ValueError('Leases are not supported in multiprocess mode')
+
+        with self._file_lock:
+            if self._leases is None:
+                sync = self.durability in (DURABILITY_ALWAYS, DURABILITY_BATCH)
+                self._leases = LeaseTable(self.filename + '.inflight', sync)
+
+        return self._leases
+
+    def _requeue(self, leases):
+        """
+        Puts the items of leases back at the end of the queue, then ends the
+        leases. A crash in between delivers the items twice rather than never.
+
+        """
+        payloads = [payload for lease in leases for payload in lease.payloads]
+        _LOGGER.debug("Redelivering %s items of %s leases", len(payloads), len(leases))
+
+        self._put_back(payloads)
+        self._lease_table().end(leases)
+
+    def _put_back(self, payloads):
+        """
+        Writes payloads, of items that were removed from the queue, at the end
+        of the queue and waits until they are durable. They were in the
+        queue already, so they do not wait for room and _put_lock is not
+        taken. They are not counted as unfinished tasks again either.
+        """
+        with self._locked():
+            self._write_records(payloads)
+            self._update_length(self._length + len(payloads))
+            seq = self._commit()
+
+        self._wait_durable(seq)
+        self._notify('put', len(payloads))
+
+    def _expire_leases(self):
+        """
+        Redelivers the items of leases whose visibility timeout passed.
+        Returns when the next lease expires, or None.
+        """
+        leases = self._lease_table()
+
+        expired = leases.take_expired(time.time())
+        if expired:
+            self._requeue(expired)
+
+        next_deadline = leases.next_deadline()
+        self._schedule_expiry(next_deadline)
+        return next_deadline
+
+    def _schedule_expiry(self, deadline):
+        """
+        Makes sure a timer runs _expire_leases() by deadline, so expired
+        leases are redelivered to get() and consume() too, and blocked calls
+        wake up for them.
+        """
+        if deadline is None:
+            return
+
+        with self._file_lock:
+            if self._lease_timer is not None:
+                if self._lease_deadline <= deadline:
+                    return
+                self._lease_timer.cancel()
+
+            self._lease_timer = threading.Timer(max(deadline - time.time(), 0), self._expire_from_timer)
+            self._lease_timer.daemon = True
+            self._lease_deadline = deadline
+            self._lease_timer.start()
+
+    def _expire_from_timer(self):
+        with self._file_lock:
+            # Replaced by a timer for an earlier lease, or the queue is closing
+            if self._lease_timer is not threading.current_thread():
+                return
+            self._lease_timer = None
+
+        try:
+            self._expire_leases()
+        except Exception:
+            _LOGGER.exception("Redelivering expired leases of %s failed", self.filename)
+
+    def lease(self, items=1, visibility_timeout=30, block=True, timeout=None):
+        """
+        Removes items from the queue like get(), but keeps them in an
+        in-flight table, stored in filename + '.inflight', until ack() is
+        called with the returned lease id. If that does not happen within
+        visibility_timeout seconds, or nack() is called, the items are put
+        back at the end of the queue.
+
+        Returns a tuple of the lease id and the items. If items is greater
+        than one, the items are a list.
+
+        Expired leases are redelivered by a timer thread, so get(),
+        consume() and blocked calls see their items too. Not supported in
+        multiprocess mode.
+        """
+        _LOGGER.debug("Leasing %s items", items)
+
+        self._lease_table()
+        start = _clock() if self.metrics is not None else None
+
+        if block and timeout is not None:
+            target = time.time() + timeout
+
+        # Like _peek(), blocked calls wait without _get_lock
+        while True:
+            next_deadline = self._expire_leases()
+
+            with self._get_lock, self._locked():
+                if self._length >= items:
+                    # The in-flight table has the items before they are
+                    # removed from the queue
+                    lease = self._leases.add(time.time() + visibility_timeout, self._read_records(0, items))
+                    self._advance(items)
+                    seq = self._commit()
+                    break
+
+            with self._locked():
+                if self._length >= items:
+                    continue
+
+                if not block:
+                    raise queue.Empty
+
+                wait = None
+                if timeout is not None:
+                    wait = target - time.time()
+                    if wait <= 0:
+                        raise queue.Empty
+
+                # Wake up when a lease expires as well
+                if next_deadline is not None:
+                    expires = max(next_deadline - time.time(), 0)
+                    wait = expires if wait is None else min(wait, expires)
+
+                self._wait(self._not_empty, self._added_fd, wait)
+
+        self._wait_durable(seq)
+        self._notify('get', items)
+        self._schedule_expiry(lease.deadline)
+
+        data = self._deserialize(lease.payloads, 'lease')
+
+        if start is not None:
+            self.metrics('lease.total', _clock() - start)
+        return lease.lease_id, data[0] if items == 1 else data
+
+    def ack(self, lease_id):
+        """
+        Marks the items of a lease as processed, they are never redelivered.
+        Raises ValueError if the lease is unknown or expired.
+        """
+        lease = self._lease_table().take(lease_id)
+        if lease is None:
+            raise ValueError('No lease {}, it might have expired'.format(lease_id))
+
+        self._leases.end([lease])
+
+    def nack(self, lease_id):
+        """
+        Puts the items of a lease back at the end of the queue right away.
+        Raises ValueError if the lease is unknown or expired.
+        """
+        lease = self._lease_table().take(lease_id)
+        if lease is None:
+            raise ValueError('No lease {}, it might have expired'.format(lease_id))
+
+        self._requeue([lease])
+
+    def consume(self, batch_size=100, max_wait=None, prefetch=1):
+        """
+        Yields lists of up to batch_size items from the top of the queue.
+        While a batch is being processed, a background thread reads and
+        deserializes up to prefetch batches after it.
+
+        A batch is removed from the queue, with a single header write, when
+        the next one is asked for. A batch that was being processed when the
+        program stopped, or when the loop was left with break, stays in the
+        queue and is handed out again.
+
+        max_wait: if there is no full batch within this many seconds, yield
+            what there is, or stop if the queue stayed empty. By default,
+            wait for full batches forever.
+        prefetch: how many batches to read ahead, at least one.
+
+        Nothing else should remove items from the queue while this runs.
+        """
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1')
+
+        prefetcher = _Prefetcher(self, batch_size, max_wait, prefetch)
+
+        try:
+            while True:
+                batch = prefetcher.batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+
+                yield batch
+                prefetcher.ack(len(batch))
+        finally:
+            prefetcher.close()
+
+    def close(self):
+        """
+        Stops the background compactor, then closes the file, and in
+        multiprocess mode the lock file and the wakeup pipes. Changes that
+        were not synced yet are synced first. The queue can not be used
+        afterwards.
+        """
+        _LOGGER.debug("Closing the queue")
+
+        # Lets a compaction that is under way finish first
+        if self._compactor is not None:
+            self._compactor.stop()
+            self._compactor = None
+
+        with self._file_lock:
+            timer, self._sync_timer = self._sync_timer, None
+        if timer is not None:
+            timer.cancel()
+            self.sync()
+
+        # Lets a redelivery of expired leases that is under way finish first,
+        # it can start another timer
+        while True:
+            with self._file_lock:
+                timer, self._lease_timer = self._lease_timer, None
+            if timer is None:
+                break
+            timer.cancel()
+            timer.join()
+
+        with self._get_lock, self._put_lock, self._file_lock:
+            if self._leases is not None:
+                self._leases.close()
+                self._leases = None
+
+            for fd in (self._lock_fd, self._added_fd, self._removed_fd):
+                if fd is not None:
+                    os.close(fd)
+            self._lock_fd = self._added_fd = self._removed_fd = None
+
+            if self._storage is not None:
+                self._storage.close()
+                self._storage = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def __len__(self):
         """
         Get size of queue.
         """
-        return self._length
+        return self._get_length()
+
+
+class _PeekCache:
+    def __init__(self, max_items=None, max_bytes=None):
+        """
+        Keeps the items peek() deserialized last, by where their records are,
+        and drops the least recently used ones beyond max_items, or once their
+        payloads take more than max_bytes.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _full(self, count, size):
+        if self.max_items and count > self.max_items:
+            return True
+        return bool(self.max_bytes and size > self.max_bytes)
+
+    def get(self, keys):
+        """
+        Returns a list of the items of keys, or None unless all of them are
+        kept.
+        """
+        if not keys:
+            return None
+
+        with self._lock:
+            if any(key not in self._items for key in keys):
+                self._misses += 1
+                return None
+
+            data = []
+            for key in keys:
+                # Most recently used last
+                entry = self._items.pop(key)
+                self._items[key] = entry
+                data.append(entry[0])
+
+            self._hits += 1
+            return data
+
+    def put(self, keys, data, payloads):
+        """
+        Keeps data, the items of keys deserialized from payloads, if there is
+        room for all of them.
+        """
+        sizes = [len(payload) for payload in payloads]
+        if self._full(len(keys), sum(sizes)):
+            return
+
+        with self._lock:
+            for key, item, size in zip(keys, data, sizes):
+                self._bytes -= self._items.pop(key, (None, 0))[1]
+                self._items[key] = (item, size)
+                self._bytes += size
+
+            while self._full(len(self._items), self._bytes):
+                self._bytes -= self._items.popitem(last=False)[1][1]
+                self._evictions += 1
+
+    def discard(self, keys):
+        with self._lock:
+            for key in keys:
+                self._bytes -= self._items.pop(key, (None, 0))[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'evictions': self._evictions,
+                'items': len(self._items),
+                'bytes': self._bytes,
+            }
+
+
+class _Compactor:
+    def __init__(self, persistent_queue):
+        """
+        Runs compact() on a queue in a background thread whenever its
+        auto_compact policy says so. The queue is only referenced weakly, the
+        thread ends once it is garbage collected.
+        """
+        self._queue = weakref.ref(persistent_queue)
+        self._stopped = threading.Event()
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(COMPACT_CHECK_INTERVAL):
+            persistent_queue = self._queue()
+            if persistent_queue is None:
+                return
+
+            try:
+                if persistent_queue._should_compact():
+                    persistent_queue.compact()
+            except Exception:
+                _LOGGER.exception("Compacting %s failed", persistent_queue.filename)
+
+            del persistent_queue
+
+
+class _Prefetcher:
+    def __init__(self, persistent_queue, batch_size, max_wait, prefetch):
+        """
+        Reads batches for PersistentQueue.consume() in a background thread.
+        Batches that were read but not acknowledged yet are skipped with
+        peek's offset, so they stay in the queue until ack().
+        """
+        self.queue = persistent_queue
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+        self.batches = queue.Queue(maxsize=prefetch)
+
+        self._unacked = 0
+        self._ack_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._closed = False
+
+        self.queue._listeners.append(self._listener)
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _listener(self, event):
+        if event == 'put':
+            self._changed.set()
+
+    def _read(self, partial):
+        """
+        Returns the batch after the ones read so far, or None if there are
+        not enough items for it. If partial is true, any number of items
+        will do.
+        """
+        # _get_lock keeps the records where they are while they are read
+        # without the file lock, like _peek() does, so producers are not
+        # blocked by the read or by loads
+        with self._ack_lock, self.queue._get_lock:
+            with self.queue._locked():
+                available = self.queue._length - self._unacked
+                if available <= 0 or (available < self.batch_size and not partial):
+                    return None
+
+                count = min(available, self.batch_size)
+                located = self.queue._locate_records(self._unacked, count)
+                payloads = None
+                if not POSITIONAL_IO or self.queue.multiprocess:
+                    payloads = self.queue._read_located(located)
+
+            if payloads is None:
+                payloads = self.queue._read_located(located)
+            self._unacked += count
+
+        return self.queue._deserialize(payloads)
+
+    def _next_batch(self):
+        if self.max_wait is not None:
+            target = time.time() + self.max_wait
+
+        while not self._closed:
+            # Cleared before looking so a put() in between is not missed
+            self._changed.clear()
+
+            batch = self._read(partial=False)
+            if batch is not None:
+                return batch
+
+            timeout = None
+            if self.max_wait is not None:
+                timeout = target - time.time()
+                if timeout <= 0:
+                    return self._read(partial=True)
+
+            # Other processes do not call the listener
+            if self.queue.multiprocess:
+                timeout = MULTIPROCESS_WAIT_SLICE if timeout is None else min(timeout, MULTIPROCESS_WAIT_SLICE)
+
+            self._changed.wait(timeout)
+
+        return None
+
+    def _run(self):
+        try:
+            while not self._closed:
+                batch = self._next_batch()
+                if batch is None:
+                    break
+                self.batches.put(batch)
+        except Exception as error:
+            self.batches.put(error)
+        else:
+            if not self._closed:
+                self.batches.put(None)
+
+    def ack(self, count):
+        """
+        Removes the oldest count items that were read from the queue.
+        """
+        with self._ack_lock:
+            self.queue.delete(count)
+            self._unacked -= count
+
+    def close(self):
+        self._closed = True
+        self._changed.set()
+
+        # Make room in case the thread is stuck handing over a batch
+        while self._thread.is_alive():
+            try:
+                while True:
+                    self.batches.get_nowait()
+            except queue.Empty:
+                pass
+            self._thread.join(0.05)
+
+        self.queue._listeners.remove(self._listener)
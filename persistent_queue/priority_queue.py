@@ -0,0 +1,302 @@
+"""
+A persistent queue with priority lanes. Every lane is a PersistentQueue of
+its own in a shared directory, and get() drains the most urgent lanes first.
+
+The lanes are separate files: a commit fsyncs every lane it changed, and a
+get() or delete() that spans several lanes is not atomic, a crash in the
+middle can leave the items of some lanes removed and the rest still queued.
+"""
+
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+from .persistent_queue import (DURABILITY_ALWAYS, DURABILITY_BATCH, DURABILITY_OS, DURABILITY_POLICIES,
+                               PersistentQueue)
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class PersistentPriorityQueue:
+    def __init__(self, dirname, lanes=2, durability=DURABILITY_ALWAYS, **kwargs):
+        """
+        Creates a new PersistentPriorityQueue object and its directory.
+
+        dirname: the directory that keeps one file per lane.
+        lanes: the number of priorities. Lane 0 is the most urgent one.
+        durability: the durability policy of PersistentQueue. With 'always'
+            and 'batch', the lanes are fsync'd by a commit shared between all
+            lanes and concurrent callers, so a put() or get() that touches
+            several lanes, or runs at the same time as calls on other lanes,
+            waits for a single round of fsyncs.
+        kwargs: passed on to the PersistentQueue of every lane. maxsize is
+            the upperbound of each lane.
+        """
+        if lanes < 1:
+            raise ValueError('lanes must be at least 1')
+
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('durability must be one of {}'.format(
+                ', '.join(DURABILITY_POLICIES)))
+
+        if kwargs.get('multiprocess'):
+            raise ValueError('PersistentPriorityQueue does not support multiprocess')
+
+        self.dirname = os.path.abspath(dirname)
+        self.durability = durability
+
+        if not os.path.isdir(self.dirname):
+            os.makedirs(self.dirname)
+
+        # The lanes leave fsyncs to the shared commit
+        shared = durability in (DURABILITY_ALWAYS, DURABILITY_BATCH)
+        lane_durability = DURABILITY_OS if shared else durability
+
+        self.lanes = [PersistentQueue(os.path.join(self.dirname, 'lane{}'.format(lane)),
+                                      durability=lane_durability, **kwargs)
+                      for lane in range(lanes)]
+
+        self._get_lock = threading.RLock()
+        self._changed = threading.Condition()
+
+        self._all_tasks_done = threading.Condition()
+        self._unfinished_tasks = 0
+
+        # Commits work like PersistentQueue's group commit, except that the
+        # lanes written since the last fsync are tracked too
+        self._sync_cond = threading.Condition()
+        self._write_seq = 0
+        self._sync_seq = 0
+        self._syncing = False
+        self._dirty = set()
+
+    def _commit(self, lanes):
+        """
+        Records that lanes were changed. Returns the sequence number to pass
+        to _wait_durable().
+        """
+        with self._sync_cond:
+            self._write_seq += 1
+            self._dirty.update(lanes)
+            return self._write_seq
+
+    def _wait_durable(self, seq):
+        if self.durability in (DURABILITY_ALWAYS, DURABILITY_BATCH):
+            self._sync(seq)
+
+    def _sync(self, seq):
+        """
+        Makes sure every commit up to seq is on disk. The first caller to get
+        here fsyncs every lane that was changed, the rest wait for it.
+        """
+        while True:
+            with self._sync_cond:
+                while self._syncing and self._sync_seq < seq:
+                    self._sync_cond.wait()
+
+                if self._sync_seq >= seq:
+                    return
+
+                self._syncing = True
+                lanes, self._dirty = self._dirty, set()
+                target = self._write_seq
+
+            synced = False
+            try:
+                for lane in sorted(lanes):
+                    self.lanes[lane].sync()
+                synced = True
+            finally:
+                with self._sync_cond:
+                    self._syncing = False
+                    if synced:
+                        self._sync_seq = max(self._sync_seq, target)
+                    else:
+                        self._dirty.update(lanes)
+                    self._sync_cond.notify_all()
+
+    def _notify(self, count=1):
+        """
+        Wakes up at most count blocked get() calls.
+        """
+        with self._changed:
+            self._changed.notify(count)
+
+    def _lane(self, priority):
+        if not 0 <= priority < len(self.lanes):
+            raise ValueError('priority must be between 0 and {}'.format(len(self.lanes) - 1))
+        return self.lanes[priority]
+
+    def sync(self):
+        """
+        Forces every change made so far to the underlying storage.
+        """
+        for lane in self.lanes:
+            lane.sync()
+
+    def qsize(self):
+        return len(self)
+
+    def empty(self):
+        return len(self) == 0
+
+    def put(self, items, priority=0, block=True, timeout=None):
+        """
+        Puts items into the lane of priority, 0 being the most urgent. Blocks
+        for room like PersistentQueue.put() if the lanes have a maxsize.
+        """
+        if not isinstance(items, list):
+            items = [items]
+
+        if len(items) == 0:
+            return
+
+        lane = self._lane(priority)
+        _LOGGER.debug("Putting %s items into lane %s", len(items), priority)
+
+        lane.put(items, block=block, timeout=timeout)
+        with self._all_tasks_done:
+            self._unfinished_tasks += len(items)
+
+        self._wait_durable(self._commit([priority]))
+        self._notify(len(items))
+
+    def put_nowait(self, items, priority=0):
+        self.put(items, priority, block=False)
+
+    def _counts(self, items, offset=0):
+        """
+        Splits items, after skipping offset of them, over the lanes in order
+        of priority. Returns (lane, offset, count) for every lane to read.
+        """
+        counts = []
+        for priority, lane in enumerate(self.lanes):
+            if items == 0:
+                break
+
+            length = len(lane)
+            skip = min(offset, length)
+            offset -= skip
+            count = min(items, length - skip)
+            if count:
+                counts.append((priority, skip, count))
+                items -= count
+
+        return counts
+
+    def get(self, block=True, timeout=None, items=1):
+        """
+        Removes and returns items, filling the batch from the most urgent
+        non-empty lane first. If items is greater than one, a list is
+        returned. Blocks until there are enough items in all the lanes
+        together, like PersistentQueue.get().
+        """
+        if items == 0:
+            return []
+
+        if block and timeout is not None:
+            target = time.time() + timeout
+
+        # Blocked calls wait without _get_lock, so the timeouts of the calls
+        # behind them still count
+        while True:
+            with self._get_lock:
+                if len(self) >= items:
+                    data = []
+                    counts = self._counts(items)
+                    for priority, _, count in counts:
+                        got = self.lanes[priority].get(block=False, items=count)
+                        data.extend(got if count > 1 else [got])
+                    break
+
+            with self._changed:
+                while len(self) < items:
+                    if not block:
+                        raise queue.Empty
+
+                    if timeout is not None:
+                        timeout = target - time.time()
+                        if timeout <= 0:
+                            raise queue.Empty
+
+                    self._changed.wait(timeout)
+
+        self._wait_durable(self._commit(priority for priority, _, _ in counts))
+
+        # Pass it on to another blocked call if items are left
+        if len(self) > 0:
+            self._notify()
+        _LOGGER.debug("Got %s items from lanes %s", len(data), [priority for priority, _, _ in counts])
+
+        return data[0] if items == 1 else data
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def peek(self, items=1, offset=0):
+        """
+        Returns items without removing them, in the order get() would return
+        them, skipping the first offset items.
+        """
+        with self._get_lock:
+            data = []
+            for priority, skip, count in self._counts(items, offset):
+                peeked = self.lanes[priority].peek(items=count, offset=skip)
+                data.extend(peeked if count > 1 else [peeked])
+
+        if items == 1:
+            return data[0] if data else None
+        return data
+
+    def delete(self, items=1):
+        """
+        Removes items, from the most urgent lanes first.
+        """
+        with self._get_lock:
+            counts = self._counts(items)
+            for priority, _, count in counts:
+                self.lanes[priority].delete(count)
+
+        self._wait_durable(self._commit(priority for priority, _, _ in counts))
+
+    def task_done(self, items=1):
+        with self._all_tasks_done:
+            unfinished = self._unfinished_tasks - items
+            if unfinished < 0:
+                raise ValueError('task_done() called too many times')
+            if unfinished == 0:
+                self._all_tasks_done.notify_all()
+            self._unfinished_tasks = unfinished
+
+    def join(self):
+        with self._all_tasks_done:
+            while self._unfinished_tasks:
+                self._all_tasks_done.wait()
+
+    def flush(self):
+        for lane in self.lanes:
+            lane.flush()
+
+    def close(self):
+        """
+        Closes the file of every lane, syncing what was not synced yet. The
+        queue can not be used afterwards.
+        """
+        with self._get_lock:
+            for lane in self.lanes:
+                lane.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return sum(len(lane) for lane in self.lanes)
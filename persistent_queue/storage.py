@@ -0,0 +1,801 @@
+"""
+Storage engines used by PersistentQueue. They only deal with bytes: where the
+header lives, how ranges of the queue's data are read and written, and how
+the space of consumed data is reclaimed.
+
+Data is addressed by position. For a single file the position is the offset
+in the file. Segmented storage keeps positions growing across segments, so
+they never change when space is reclaimed.
+"""
+
+import bisect
+import errno
+import logging
+import mmap
+import os
+import shutil
+import struct
+import time
+import uuid
+import zlib
+
+# The header starts with the magic number, the format version and flags. Two
+# slots follow, each able to hold the state of the queue: a sequence number,
+# the length of the queue, the position of the top of the queue and a CRC32 of
+# the three. Every commit writes the slot the last state is not in, so a torn
+# write leaves the last state whole in the other slot. The slot with the
+# highest sequence number and a valid CRC is the current state.
+MAGIC = b'PQUE'
+FORMAT_VERSION = 2
+PREFIX_STRUCT = '<4sHH'
+FLAGS_STRUCT = '<H'
+FLAGS_OFFSET = 6
+STATE_STRUCT = '<QQQ'
+STATE_SIZE = struct.calcsize(STATE_STRUCT)
+CRC_STRUCT = '<I'
+SLOT_SIZE = STATE_SIZE + struct.calcsize(CRC_STRUCT)
+SLOT_OFFSETS = (struct.calcsize(PREFIX_STRUCT), struct.calcsize(PREFIX_STRUCT) + SLOT_SIZE)
+START_OFFSET = 64
+
+# The flags hold the number of the codec records are compressed with, and
+# whether records are framed in blocks, one or more per put()
+CODEC_MASK = 0xff
+FLAG_BLOCKS = 0x100
+
+# With block framing, the top of the queue can be in the middle of a block.
+# The number of records of that block that were already removed is then kept
+# in the highest bits of the top field.
+SKIP_SHIFT = 48
+POSITION_MASK = (1 << SKIP_SHIFT) - 1
+
+# Files written before the header had a version: 32-bit length and top
+LEGACY_HEADER_STRUCT = 'II'
+LEGACY_START_OFFSET = 4 + 4
+
+SEGMENT_SUFFIX = '.segment'
+
+# Compacting copies data this many bytes at a time, through a buffer of
+# COPY_BUFFER_SIZE when the kernel can not copy it by itself
+COPY_CHUNK_SIZE = 64 * 1024 * 1024
+COPY_BUFFER_SIZE = 1024 * 1024
+MANIFEST_NAME = 'manifest'
+
+# writev() takes at most this many buffers at once
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):  # pragma: no cover
+    IOV_MAX = 1024
+
+# os.pread() and os.pwrite() do not use the file position, so data can be read
+# while other threads write to the same file
+POSITIONAL_IO = hasattr(os, 'pread')
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def pack_slot(seq, length, top):
+    state = struct.pack(STATE_STRUCT, seq, length, top)
+    return state + struct.pack(CRC_STRUCT, zlib.crc32(state) & 0xffffffff)
+
+
+def pack_header(length, top, flags=0):
+    """
+    Returns a whole header, with the state in the first slot and the second
+    one empty.
+    """
+    header = struct.pack(PREFIX_STRUCT, MAGIC, FORMAT_VERSION, flags) + pack_slot(0, length, top)
+    return header + b'\0' * (START_OFFSET - len(header))
+
+
+def split_top(top):
+    """
+    Returns the position and the number of records to skip stored in the top
+    field of a header.
+    """
+    return top & POSITION_MASK, top >> SKIP_SHIFT
+
+
+def join_top(pos, skip):
+    return pos | (skip << SKIP_SHIFT)
+
+
+def unpack_header(data, filename):
+    """
+    Returns the sequence number, the length and the top of the queue stored
+    in a header.
+    """
+    magic, version, _ = struct.unpack_from(PREFIX_STRUCT, data)
+
+    if magic != MAGIC:
+        raise IOError('{} is not a queue file'.format(filename))
+
+    if version > FORMAT_VERSION:
+        raise IOError('{} uses format version {}, only versions up to {} are supported'.format(
+            filename, version, FORMAT_VERSION))
+
+    states = []
+    for offset in SLOT_OFFSETS:
+        state = data[offset:offset + STATE_SIZE]
+        crc = struct.unpack_from(CRC_STRUCT, data, offset + STATE_SIZE)[0]
+        if zlib.crc32(state) & 0xffffffff == crc:
+            states.append(struct.unpack(STATE_STRUCT, state))
+
+    if not states:
+        raise IOError('The header of {} is corrupted'.format(filename))
+
+    return max(states)
+
+
+def _datasync(fd):
+    """
+    Flushes the data of fd to disk, without the metadata that is not needed
+    to read it back, like the modification time.
+    """
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:  # pragma: no cover
+        os.fsync(fd)
+
+
+def _copy_file_range(source, destination, pos, count):
+    return os.copy_file_range(source, destination, count, pos)
+
+
+def _sendfile(source, destination, pos, count):
+    return os.sendfile(destination, source, pos, count)
+
+
+def _read_write(source, destination, pos, count):
+    os.lseek(source, pos, os.SEEK_SET)
+    data = memoryview(os.read(source, min(count, COPY_BUFFER_SIZE)))
+
+    written = 0
+    while written < len(data):
+        written += os.write(destination, data[written:])
+
+    return len(data)
+
+
+# Ways to copy part of a file to the current position of another, best first.
+# Each one returns how many bytes it copied, 0 at the end of the source.
+COPIERS = []
+if hasattr(os, 'copy_file_range'):
+    COPIERS.append(_copy_file_range)
+if hasattr(os, 'sendfile'):
+    COPIERS.append(_sendfile)
+COPIERS.append(_read_write)
+
+# What a copier raises when it can not copy between these files
+_UNSUPPORTED_COPY_ERRORS = set(getattr(errno, name) for name in
+                               ('EXDEV', 'ENOSYS', 'EINVAL', 'ENOTSOCK', 'EOPNOTSUPP', 'ENOTSUP')
+                               if hasattr(errno, name))
+
+
+def is_legacy_file(filename):
+    """
+    Returns True if filename is a queue file from before the header had a
+    magic number and a version.
+    """
+    if not os.path.isfile(filename):
+        return False
+
+    with open(filename, 'rb') as file:
+        return file.read(len(MAGIC)) != MAGIC
+
+
+class DataFile:
+    def __init__(self, filename, base=0, use_mmap=False, initial=None):
+        """
+        Opens a file holding the queue's data from position base onwards,
+        creating it if needed.
+
+        filename: must be a full path to the file.
+        base: position of the first byte of the file.
+        use_mmap: read through a memory map of the file instead of read() calls.
+        initial: bytes written to the file when it is created.
+        """
+        self.filename = filename
+        self.base = base
+        self.use_mmap = use_mmap
+
+        self._mmap = None
+
+        if initial is not None and not os.path.isfile(filename):
+            self.file = open(filename, mode='w+b', buffering=0)
+            self.file.write(initial)
+        else:
+            mode = 'r+b' if os.path.isfile(filename) else 'w+b'
+            self.file = open(filename, mode=mode, buffering=0)
+
+        self.end = base + os.fstat(self.file.fileno()).st_size
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def refresh(self):
+        """
+        Picks up the size of the file after another process wrote to it.
+        """
+        self.end = self.base + os.fstat(self.file.fileno()).st_size
+
+    def write(self, pos, data):
+        view = memoryview(data)
+        offset = pos - self.base
+
+        if POSITIONAL_IO:
+            fd = self.file.fileno()
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+        else:  # pragma: no cover
+            self.file.seek(offset, 0)
+            while view:
+                view = view[self.file.write(view):]
+
+        self.end = max(self.end, pos + len(data))
+
+    def writev(self, pos, buffers):
+        """
+        Writes buffers one after the other from pos on, with as few pwritev()
+        or writev() calls as possible so they are never copied into one
+        buffer.
+        """
+        if not hasattr(os, 'writev'):  # pragma: no cover
+            self.write(pos, b''.join(bytes(buf) for buf in buffers))
+            return
+
+        fd = self.file.fileno()
+        offset = pos - self.base
+        positional = hasattr(os, 'pwritev')
+        if not positional:  # pragma: no cover
+            self.file.seek(offset, 0)
+
+        views = [memoryview(buf) for buf in buffers]
+        size = sum(len(view) for view in views)
+        first = 0
+        while first < len(views):
+            if positional:
+                written = os.pwritev(fd, views[first:first + IOV_MAX], offset)
+                offset += written
+            else:  # pragma: no cover
+                written = os.writev(fd, views[first:first + IOV_MAX])
+
+            # Skip what was written, a buffer might have been cut short
+            while first < len(views) and written >= len(views[first]):
+                written -= len(views[first])
+                first += 1
+            if written:
+                views[first] = views[first][written:]
+
+        self.end = max(self.end, pos + size)
+
+    def truncate(self, pos):
+        # The file shrinks, so the mapping has to go
+        self._mmap = None
+        self.file.truncate(pos - self.base)
+        self.end = pos
+
+    def read(self, start, end):
+        """
+        Returns a memoryview of the bytes between start and end.
+        """
+        if start == end:
+            return memoryview(b'')
+
+        if self.use_mmap:
+            if self._mmap is None or len(self._mmap) < end - self.base:
+                self._remap(end)
+            return memoryview(self._mmap)[start - self.base:end - self.base]
+
+        buf = bytearray(end - start)
+        view = memoryview(buf)
+        offset = start - self.base
+
+        if not POSITIONAL_IO:  # pragma: no cover
+            self.file.seek(offset, 0)
+
+        while view:
+            read = self._read_into(view, offset)
+            if not read:
+                raise IOError('{} ends in the middle of a record'.format(self.filename))
+            view = view[read:]
+            offset += read
+
+        return memoryview(buf)
+
+    def _read_into(self, view, offset):
+        """
+        Reads into view from offset in the file, or from the file position
+        without positional I/O. Returns how many bytes were read.
+        """
+        if hasattr(os, 'preadv'):
+            return os.preadv(self.file.fileno(), [view], offset)
+
+        if POSITIONAL_IO:  # pragma: no cover
+            data = os.pread(self.file.fileno(), len(view), offset)
+            view[:len(data)] = data
+            return len(data)
+
+        return self.file.readinto(view)  # pragma: no cover
+
+    def _remap(self, end):
+        """
+        Maps the whole file again after it grew.
+        """
+        # The old mapping is not closed: memoryviews handed out to loads()
+        # may still reference it, it goes away with the last of them.
+        self._mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mmap) < end - self.base:
+            raise IOError('{} ends in the middle of a record'.format(self.filename))
+
+    def close(self):
+        self._mmap = None
+        self.file.close()
+
+
+class FileStorage:
+    def __init__(self, filename, use_mmap=False):
+        """
+        Keeps the header and all the data of a queue in a single file. Space
+        is reclaimed by copying the live data to a new file.
+        """
+        self.filename = filename
+        self.use_mmap = use_mmap
+        self.start = START_OFFSET
+
+        # Bytes copied by compactions and the time it took
+        self.bytes_copied = 0
+        self.copy_seconds = 0.0
+
+        self._data = self._open()
+
+    def _open(self):
+        data = DataFile(self.filename,
+                        use_mmap=self.use_mmap,
+                        initial=pack_header(0, START_OFFSET))
+
+        # The sequence number, length and top of the current state
+        try:
+            self._state = unpack_header(data.read(0, START_OFFSET), self.filename)
+        except Exception:
+            data.close()
+            raise
+
+        return data
+
+    @property
+    def end(self):
+        return self._data.end
+
+    def read_header(self):
+        """
+        Returns the length and the top of the queue.
+        """
+        self._state = unpack_header(self._data.read(0, START_OFFSET), self.filename)
+        return self._state[1:]
+
+    @property
+    def top(self):
+        """
+        The top of the queue as it was last read or written, without reading
+        the header.
+        """
+        return self._state[2]
+
+    def read_flags(self):
+        return struct.unpack_from(FLAGS_STRUCT, self._data.read(0, START_OFFSET), FLAGS_OFFSET)[0]
+
+    def write_length(self, length):
+        self.write_state(length, self._state[2])
+
+    def write_top(self, top):
+        self.write_state(self._state[1], top)
+
+    def write_state(self, length, top):
+        # A single write, to the slot the current state is not in
+        seq = self._state[0] + 1
+        self._data.write(SLOT_OFFSETS[seq % 2], pack_slot(seq, length, top))
+        self._state = (seq, length, top)
+
+    def write_flags(self, flags):
+        self._data.write(FLAGS_OFFSET, struct.pack(FLAGS_STRUCT, flags))
+
+    def read(self, start, end):
+        return self._data.read(start, end)
+
+    def write(self, pos, data):
+        self._data.write(pos, data)
+
+    def writev(self, pos, buffers):
+        self._data.writev(pos, buffers)
+
+    def truncate(self, pos):
+        """
+        Removes everything from pos on.
+        """
+        self._data.truncate(pos)
+
+    def refresh(self):
+        """
+        Picks up changes made by other processes. Returns True if the file was
+        replaced, by compact() or clear(), and had to be opened again.
+        """
+        if os.stat(self.filename).st_ino != os.fstat(self._data.fileno()).st_ino:
+            self._data.close()
+            self._data = self._open()
+            return True
+
+        self._data.refresh()
+        return False
+
+    def prepare_sync(self):
+        """
+        Returns a function that fsyncs everything written so far. Must be
+        called with the queue's file lock held, the function can run without.
+        """
+        # dup() so compact() or clear() can close the file under us
+        fd = os.dup(self._data.fileno())
+
+        def sync():
+            try:
+                _datasync(fd)
+            finally:
+                os.close(fd)
+
+        return sync
+
+    def sync(self):
+        _datasync(self._data.fileno())
+
+    def compact(self, top, length):
+        """
+        Removes the data before top by copying everything after it to a new
+        file. Returns how far the remaining data moved.
+        """
+        # Make sure everything is to disk
+        self.sync()
+
+        return self.start_compaction(split_top(top)[0]).finish(top, length)
+
+    def reclaimable(self, top):
+        """
+        Returns how many bytes compact() would free.
+        """
+        return split_top(top)[0] - self.start
+
+    def start_compaction(self, start):
+        """
+        Returns a Compaction that copies the data from start on to a new file
+        in steps, while the queue keeps being used.
+        """
+        return Compaction(self, start)
+
+    def clear(self):
+        self._data.close()
+        os.remove(self.filename)
+        self._data = self._open()
+
+    def copy(self, new_filename):
+        shutil.copy2(self.filename, new_filename)
+
+    def close(self):
+        self._data.close()
+
+
+class Compaction:
+    def __init__(self, storage, start):
+        """
+        Copies the data of a FileStorage from start on to a new file. copy()
+        can run without holding the queue's locks: the data is only ever
+        appended to, and it is read through a file descriptor of its own. The
+        queue must be locked for finish().
+
+        The kernel copies the data when it can (copy_file_range() or
+        sendfile()), so it never goes through Python.
+        """
+        self.storage = storage
+        self.start = start
+        self.copied = start
+
+        random = str(uuid.uuid4()).replace('-', '')
+        self.temp_filename = storage.filename + '-' + random
+
+        self._source = os.open(storage.filename, os.O_RDONLY)
+        self._new_file = os.open(self.temp_filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        self._copiers = list(COPIERS)
+
+        # The header is written last
+        os.write(self._new_file, pack_header(0, START_OFFSET))
+
+    def copy(self, end, limit=None):
+        """
+        Copies the data up to end, or limit bytes of it. Returns how many
+        bytes were copied.
+        """
+        if limit is not None:
+            end = min(end, self.copied + limit)
+
+        begin = time.time()
+        copied = self.copied
+
+        while self.copied < end:
+            count = min(end - self.copied, COPY_CHUNK_SIZE)
+            try:
+                read = self._copiers[0](self._source, self._new_file, self.copied, count)
+            except OSError as error:
+                if error.errno not in _UNSUPPORTED_COPY_ERRORS or len(self._copiers) == 1:
+                    raise
+                _LOGGER.debug("Can not copy with %s: %s", self._copiers[0].__name__, error)
+                self._copiers.pop(0)
+                continue
+
+            if not read:
+                raise IOError('{} ends in the middle of a record'.format(self.storage.filename))
+            self.copied += read
+
+        self.storage.bytes_copied += self.copied - copied
+        self.storage.copy_seconds += time.time() - begin
+
+        return self.copied - copied
+
+    def finish(self, top, length):
+        """
+        Copies what is left and replaces the storage's file with the new one.
+        Returns how far the data moved, or None if the file was replaced in
+        the meantime, by clear() or another compaction, and nothing was done.
+        """
+        if os.stat(self.storage.filename).st_ino != os.fstat(self._source).st_ino:
+            self.abort()
+            return None
+
+        begin = time.time()
+        copied = self.copy(self.storage.end)
+        seconds = time.time() - begin
+        _LOGGER.debug("Copied the last %s bytes in %.3f s (%.1f MB/s)",
+                      copied, seconds, copied / 1e6 / seconds if seconds else 0)
+
+        shift = self.start - START_OFFSET
+        pos, skip = split_top(top)
+
+        _LOGGER.debug("Writing data to new file")
+        # Copy over meta data
+        os.lseek(self._new_file, 0, os.SEEK_SET)
+        os.write(self._new_file, pack_header(length, join_top(pos - shift, skip), self.storage.read_flags()))
+
+        os.fsync(self._new_file)
+        os.close(self._new_file)
+        os.close(self._source)
+        self.storage._data.close()
+
+        # So far everything above this point has been safe. If something
+        # crashed, the data would still be preserved. Now we are entering
+        # the danger zone.
+
+        _LOGGER.debug("Replacing old file with new file")
+        os.remove(self.storage.filename)
+        os.rename(self.temp_filename, self.storage.filename)
+        self.storage._data = self.storage._open()
+
+        return shift
+
+    def abort(self):
+        os.close(self._new_file)
+        os.close(self._source)
+        os.remove(self.temp_filename)
+
+
+class SegmentedStorage:
+    def __init__(self, dirname, segment_size, use_mmap=False):
+        """
+        Keeps the data of a queue in a directory of segment files, each named
+        after the position of its first byte, and the header in a small
+        manifest file. Space is reclaimed by removing consumed segments.
+
+        segment_size: a new segment is started once a write would make the
+            current one larger than this.
+        """
+        self.filename = dirname
+        self.segment_size = segment_size
+        self.use_mmap = use_mmap
+
+        # Compacting never copies
+        self.bytes_copied = 0
+        self.copy_seconds = 0.0
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self._manifest = DataFile(os.path.join(dirname, MANIFEST_NAME),
+                                  initial=pack_header(0, START_OFFSET))
+        try:
+            self.read_header()
+        except Exception:
+            self._manifest.close()
+            raise
+
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                       for name in os.listdir(dirname)
+                       if name.endswith(SEGMENT_SUFFIX))
+
+        self._segments = [self._open_segment(base) for base in bases or [START_OFFSET]]
+        self._bases = [segment.base for segment in self._segments]
+        self._dirty = set()
+        self._new_segment = not bases
+
+    def _open_segment(self, base):
+        filename = os.path.join(self.filename, '{:020d}{}'.format(base, SEGMENT_SUFFIX))
+        return DataFile(filename, base, self.use_mmap)
+
+    @property
+    def start(self):
+        return self._segments[0].base
+
+    @property
+    def end(self):
+        return self._segments[-1].end
+
+    def read_header(self):
+        """
+        Returns the length and the top of the queue.
+        """
+        self._state = unpack_header(self._manifest.read(0, START_OFFSET), self._manifest.filename)
+        return self._state[1:]
+
+    @property
+    def top(self):
+        return self._state[2]
+
+    def read_flags(self):
+        return struct.unpack_from(FLAGS_STRUCT, self._manifest.read(0, START_OFFSET), FLAGS_OFFSET)[0]
+
+    def write_length(self, length):
+        self.write_state(length, self._state[2])
+
+    def write_top(self, top):
+        self.write_state(self._state[1], top)
+
+    def write_state(self, length, top):
+        seq = self._state[0] + 1
+        self._manifest.write(SLOT_OFFSETS[seq % 2], pack_slot(seq, length, top))
+        self._state = (seq, length, top)
+        self._dirty.add(self._manifest)
+
+    def write_flags(self, flags):
+        self._manifest.write(FLAGS_OFFSET, struct.pack(FLAGS_STRUCT, flags))
+        self._dirty.add(self._manifest)
+
+    def read(self, start, end):
+        index = bisect.bisect_right(self._bases, start) - 1
+        segment = self._segments[index]
+        if end <= segment.end:
+            return segment.read(start, end)
+
+        # Only happens when a read spans segments
+        buf = bytearray()
+        while start < end:
+            segment = self._segments[index]
+            buf += segment.read(start, min(end, segment.end))
+            start = segment.end
+            index += 1
+
+        return memoryview(buf)
+
+    def write(self, pos, data):
+        self.writev(pos, [data])
+
+    def writev(self, pos, buffers):
+        segment = self._segments[-1]
+        size = sum(len(buf) for buf in buffers)
+
+        # Writes are never split, so records never span segments
+        if segment.end > segment.base and segment.end - segment.base + size > self.segment_size:
+            _LOGGER.debug("Starting a new segment at %s", pos)
+            segment = self._open_segment(pos)
+            self._segments.append(segment)
+            self._bases.append(pos)
+            self._new_segment = True
+
+        segment.writev(pos, buffers)
+        self._dirty.add(segment)
+
+    def truncate(self, pos):
+        """
+        Removes everything from pos on.
+        """
+        while len(self._segments) > 1 and self._segments[-1].base >= pos:
+            segment = self._segments.pop()
+            self._bases.pop()
+            self._dirty.discard(segment)
+            self._new_segment = True
+
+            segment.close()
+            os.remove(segment.filename)
+
+        self._segments[-1].truncate(pos)
+        self._dirty.add(self._segments[-1])
+
+    def prepare_sync(self):
+        """
+        Returns a function that fsyncs everything written so far. Must be
+        called with the queue's file lock held, the function can run without.
+        """
+        # dup() so compact() or clear() can close the files under us
+        fds = [os.dup(data.fileno()) for data in self._dirty]
+        dir_fd = os.open(self.filename, os.O_RDONLY) if self._new_segment else None
+
+        self._dirty = set()
+        self._new_segment = False
+
+        def sync():
+            try:
+                for fd in fds:
+                    _datasync(fd)
+                # The directory the new segment was created in
+                if dir_fd is not None:
+                    os.fsync(dir_fd)
+            finally:
+                for fd in fds:
+                    os.close(fd)
+                if dir_fd is not None:
+                    os.close(dir_fd)
+
+        return sync
+
+    def sync(self):
+        self.prepare_sync()()
+
+    def compact(self, top, length):
+        """
+        Removes the segments that only hold data before top. Nothing is
+        copied, so the remaining data never moves.
+        """
+        start = split_top(top)[0]
+
+        # The new top must be on disk before the data it skips goes away
+        self.sync()
+
+        while len(self._segments) > 1 and self._segments[0].end <= start:
+            segment = self._segments.pop(0)
+            self._bases.pop(0)
+            self._dirty.discard(segment)
+
+            _LOGGER.debug("Removing segment %s", segment.filename)
+            segment.close()
+            os.remove(segment.filename)
+
+        return 0
+
+    def reclaimable(self, top):
+        start = split_top(top)[0]
+
+        # The last segment is always kept
+        index = bisect.bisect_right(self._bases, start) - 1
+        if index > 0 and self._segments[index].base == start:
+            return start - self.start
+        return self._segments[index].base - self.start
+
+    def start_compaction(self, start):
+        # Nothing to copy, compact() is cheap enough already
+        return None
+
+    def clear(self):
+        for segment in self._segments:
+            segment.close()
+            os.remove(segment.filename)
+
+        self._manifest.write(0, pack_header(0, START_OFFSET))
+        self._state = (0, 0, START_OFFSET)
+        self._segments = [self._open_segment(START_OFFSET)]
+        self._bases = [START_OFFSET]
+        self._dirty = set([self._manifest])
+        self._new_segment = True
+
+    def copy(self, new_dirname):
+        shutil.copytree(self.filename, new_dirname)
+
+    def close(self):
+        self._manifest.close()
+        for segment in self._segments:
+            segment.close()
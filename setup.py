@@ -18,6 +18,7 @@ setup(
     include_package_data=True,
     test_suite='tests',
     zip_safe=False,
+    python_requires='>=3.4',
     url='https://github.com/philipbl/python-persistent-queue',
     description='A persistent queue. It is optimized for peeking at values and'
                 ' then deleting them off to top of the queue.',
@@ -25,8 +26,6 @@ setup(
         "License :: OSI Approved :: MIT License",
         "Development Status :: 5 - Production/Stable",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
         "Programming Language :: Python :: 3.4",
         "Programming Language :: Python :: 3.5",
@@ -0,0 +1,303 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+import pytest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from persistent_queue import AsyncPersistentQueue, PersistentQueue
+
+
+@pytest.fixture(autouse=True)
+def t(tmpdir):
+    os.chdir(str(tmpdir))
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class TestAsyncPersistentQueue:
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.queue = AsyncPersistentQueue(PersistentQueue(filename))
+
+    def teardown_method(self):
+        self.queue.close()
+        if os.path.isfile(self.queue.queue.filename):
+            os.remove(self.queue.queue.filename)
+
+    def test_put_get(self):
+        async def main():
+            await self.queue.put(1)
+            await self.queue.put([2, 3, 4])
+            await self.queue.put([])
+            assert len(self.queue) == 4
+
+            assert await self.queue.peek() == 1
+            assert await self.queue.peek(items=2, offset=2) == [3, 4]
+            assert await self.queue.get() == 1
+            assert await self.queue.get(items=2) == [2, 3]
+
+            await self.queue.delete()
+            assert self.queue.empty() is True
+
+            with pytest.raises(queue.Empty):
+                await self.queue.get(timeout=0.1)
+
+            with pytest.raises(queue.Empty):
+                await self.queue.peek(block=True, timeout=0.1)
+
+        run(main())
+
+    def test_get_blocking(self):
+        async def producer():
+            await asyncio.sleep(0.1)
+            await self.queue.put([1, 2])
+
+        async def main():
+            task = asyncio.ensure_future(producer())
+            assert await self.queue.get(items=2) == [1, 2]
+            await task
+
+        run(main())
+
+    def test_wakeup_from_thread(self):
+        def producer():
+            time.sleep(0.1)
+            self.queue.queue.put(5)
+
+        async def main():
+            t = threading.Thread(target=producer)
+            t.start()
+            assert await self.queue.get(timeout=5) == 5
+            t.join()
+
+        run(main())
+
+    def test_wakeup_from_other_process(self):
+        filename = self.queue.queue.filename + '.shared'
+        aq = AsyncPersistentQueue(PersistentQueue(filename, multiprocess=True))
+        # Another process, as far as the wakeups go: it has its own listeners
+        other = PersistentQueue(filename, multiprocess=True)
+
+        def producer():
+            time.sleep(0.1)
+            other.put(5)
+
+        async def main():
+            t = threading.Thread(target=producer)
+            t.start()
+            start = time.time()
+            assert await aq.get(timeout=5) == 5
+            # Woken up by the pipe, not by MULTIPROCESS_WAIT_SLICE
+            assert time.time() - start < 0.5
+            t.join()
+
+            with pytest.raises(queue.Empty):
+                await aq.get(timeout=0.1)
+
+        try:
+            run(main())
+        finally:
+            aq.close()
+            aq.queue.close()
+            other.close()
+            for suffix in ('', '.lock', '.added', '.removed'):
+                os.remove(filename + suffix)
+
+    def test_many_producers(self):
+        async def main():
+            await asyncio.gather(*[self.queue.put(i) for i in range(500)])
+            assert len(self.queue) == 500
+            assert sorted(await self.queue.get(items=500)) == list(range(500))
+
+        run(main())
+
+    def test_maxsize(self):
+        self.queue.queue.maxsize = 2
+
+        async def consumer():
+            await asyncio.sleep(0.1)
+            assert await self.queue.get() == 1
+
+        async def main():
+            await self.queue.put([1, 2])
+
+            with pytest.raises(queue.Full):
+                await self.queue.put(3, timeout=0.1)
+
+            task = asyncio.ensure_future(consumer())
+            await self.queue.put(3, timeout=5)
+            await task
+            assert await self.queue.get(items=2) == [2, 3]
+
+        run(main())
+
+    def test_maxsize_many_producers(self):
+        self.queue.queue.maxsize = 10
+
+        async def producer(n):
+            for i in range(50):
+                await self.queue.put(n * 100 + i)
+
+        async def consumer(items):
+            while len(items) < 1000:
+                try:
+                    items.append(await self.queue.get(timeout=0.1))
+                except queue.Empty:
+                    pass
+
+        async def main():
+            items = []
+            # More producers than there is room for
+            producers = [producer(n) for n in range(20)]
+            consumers = [consumer(items) for _ in range(5)]
+            await asyncio.wait_for(asyncio.gather(*(producers + consumers)), 30)
+            assert sorted(items) == sorted(n * 100 + i for n in range(20) for i in range(50))
+            assert self.queue._pending_count == 0
+
+        run(main())
+
+    def test_full_does_not_block_loop(self):
+        locked = threading.Event()
+        release = threading.Event()
+
+        def fsync():
+            # Holds the file lock like a put() fsyncing with 'always'
+            with self.queue.queue._file_lock:
+                locked.set()
+                release.wait(5)
+
+        async def main():
+            t = threading.Thread(target=fsync)
+            t.start()
+            locked.wait(5)
+
+            put = asyncio.ensure_future(self.queue.put(1))
+            start = time.time()
+            await asyncio.sleep(0.01)
+            assert time.time() - start < 0.5
+            assert not put.done()
+
+            release.set()
+            await asyncio.wait_for(put, 5)
+            t.join()
+            assert len(self.queue) == 1
+
+        run(main())
+
+    def test_cancelled_get_keeps_items(self):
+        locked = threading.Event()
+        release = threading.Event()
+
+        def fsync():
+            with self.queue.queue._file_lock:
+                locked.set()
+                release.wait(5)
+
+        async def cancel_get(items):
+            locked.clear()
+            release.clear()
+            t = threading.Thread(target=fsync)
+            t.start()
+            locked.wait(5)
+
+            # Times out while the executor is removing the items
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(self.queue.get(items=items), 0.1)
+            release.set()
+            t.join()
+
+            # Lets the removal finish and put the items back
+            await self.queue._run(lambda: None)
+            await self.queue._run(lambda: None)
+
+        async def main():
+            await self.queue.put([[1], [2], [3]])
+
+            await cancel_get(1)
+            assert len(self.queue) == 3
+            assert await self.queue.peek(items=3) == [[2], [3], [1]]
+
+            await cancel_get(2)
+            assert await self.queue.peek(items=3) == [[1], [2], [3]]
+
+        run(main())
+
+        # They are on disk, not only in memory
+        q = PersistentQueue(self.queue.queue.filename)
+        assert q.get(items=3) == [[1], [2], [3]]
+
+    def test_max_bytes_timeout(self):
+        item = os.urandom(5000)
+
+        async def main():
+            await self.queue.put(item)
+            self.queue.queue.max_bytes = 6000
+
+            # There is room for one byte, but not for the item
+            assert self.queue.full() is False
+            with pytest.raises(queue.Full):
+                await asyncio.wait_for(self.queue.put(item, timeout=0.2), 5)
+
+            # A cancelled put is not written once there is room
+            put = asyncio.ensure_future(self.queue.put(item))
+            await asyncio.sleep(0.1)
+            put.cancel()
+            await self.queue.get()
+            await self.queue.put(b'last', timeout=5)
+            assert await self.queue.get() == b'last'
+            assert self.queue.empty()
+
+        run(main())
+
+    def test_max_bytes_calls_that_fit(self):
+        item = os.urandom(3000)
+        self.queue.queue.put(item)
+        with self.queue.queue._file_lock:
+            size = self.queue.queue._bytes()[0]
+        self.queue.queue.get()
+        self.queue.queue.max_bytes = size * 2 + size // 2
+
+        async def main():
+            # Together they do not fit, but two of them do
+            results = await asyncio.gather(*[self.queue.put(item, timeout=0.5) for _ in range(4)],
+                                           return_exceptions=True)
+            assert sum(1 for result in results if isinstance(result, queue.Full)) == 2
+            assert len(self.queue) == 2
+
+            # The rest are written once there is room
+            puts = asyncio.gather(*[self.queue.put(item, timeout=5) for _ in range(2)])
+            await asyncio.sleep(0.1)
+            assert await self.queue.get(items=2) == [item, item]
+            await asyncio.wait_for(puts, 5)
+            assert len(self.queue) == 2
+
+        run(main())
+
+    def test_join_and_iterate(self):
+        async def worker(seen):
+            async for item in self.queue:
+                seen.append(item)
+                self.queue.task_done()
+
+        async def main():
+            seen = []
+            await self.queue.put(list(range(10)))
+            task = asyncio.ensure_future(worker(seen))
+            await asyncio.wait_for(self.queue.join(), 5)
+            task.cancel()
+            assert seen == list(range(10))
+
+        run(main())
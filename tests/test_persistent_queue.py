@@ -1,5 +1,11 @@
+import array
+import errno
+import json
+import multiprocessing
 import os
 import random
+import shutil
+import struct
 import threading
 import time
 import uuid
@@ -11,6 +17,10 @@ except ImportError:
     import Queue as queue
 
 from persistent_queue import PersistentQueue
+from persistent_queue.metrics import Metrics
+import persistent_queue.persistent_queue as pq_module
+import persistent_queue.leases as leases_module
+import persistent_queue.storage as storage_module
 
 
 @pytest.fixture(autouse=True)
@@ -18,6 +28,13 @@ def t(tmpdir):
     os.chdir(str(tmpdir))
 
 
+def remove_queue(filename):
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.isfile(filename):
+        os.remove(filename)
+
+
 class TestPersistentQueue:
     def setup_method(self):
         random = str(uuid.uuid4()).replace('-', '')
@@ -25,8 +42,7 @@ class TestPersistentQueue:
         self.queue = PersistentQueue(filename)
 
     def teardown_method(self):
-        if os.path.isfile(self.queue.filename):
-            os.remove(self.queue.filename)
+        remove_queue(self.queue.filename)
 
     def test_simple(self):
         random = str(uuid.uuid4()).replace('-', '')
@@ -43,6 +59,72 @@ class TestPersistentQueue:
 
         os.remove(filename)
 
+    def test_durability(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        with pytest.raises(ValueError):
+            PersistentQueue(filename, durability='sometimes')
+
+        for durability in ('always', 'batch', 'interval', 'os'):
+            q = PersistentQueue(filename,
+                                dumps=self.queue.dumps,
+                                loads=self.queue.loads,
+                                durability=durability,
+                                sync_interval_ms=10)
+            q.put([1, 2, 3])
+            assert q.get() == 1
+            q.delete(1)
+            q.sync()
+            assert PersistentQueue(filename, loads=self.queue.loads).peek(items=2) == [3]
+            q.clear()
+
+        os.remove(filename)
+
+    def test_put_fsyncs_once(self, monkeypatch):
+        calls = []
+
+        def counting(sync):
+            def counting_sync(fd):
+                calls.append(fd)
+                sync(fd)
+            return counting_sync
+
+        monkeypatch.setattr(storage_module.os, 'fsync', counting(os.fsync))
+        if hasattr(os, 'fdatasync'):
+            monkeypatch.setattr(storage_module.os, 'fdatasync', counting(os.fdatasync))
+
+        self.queue.put(list(range(1000)))
+        assert len(calls) == 1
+        assert len(self.queue) == 1000
+
+        self.queue.get(items=500)
+        assert len(calls) == 2
+
+    def test_group_commit(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+        q = PersistentQueue(filename,
+                            dumps=self.queue.dumps,
+                            loads=self.queue.loads,
+                            durability='batch')
+
+        def producer(n):
+            for i in range(50):
+                q.put(n * 100 + i)
+
+        threads = [threading.Thread(target=producer, args=(n,)) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(q) == 400
+        assert q._sync_seq == q._write_seq
+        assert sorted(q.get(items=400)) == sorted(n * 100 + i for n in range(8) for i in range(50))
+
+        os.remove(filename)
+
     def test_qsize(self):
 
         assert len(self.queue) == 0
@@ -92,6 +174,23 @@ class TestPersistentQueue:
         with pytest.raises(queue.Full):
             self.queue.put(b'full', block=False)
 
+    def test_loads_gets_bytes(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        # json.loads does not take memoryviews
+        q = PersistentQueue(filename,
+                            dumps=lambda item: json.dumps(item).encode(),
+                            loads=json.loads,
+                            segment_size=self.queue.segment_size,
+                            compression=self.queue.compression,
+                            compress_batches=self.queue.compress_batches)
+        q.put([{'a': 1}, [2], 3])
+        assert q.peek(items=2) == [{'a': 1}, [2]]
+        assert q.get(items=3) == [{'a': 1}, [2], 3]
+
+        remove_queue(filename)
+
     def test_get(self):
         self.queue.put(b'a')
         self.queue.put(b'b')
@@ -140,6 +239,263 @@ class TestPersistentQueue:
         with pytest.raises(queue.Empty):
             self.queue.get(timeout=1)
 
+    def test_blocked_consumers_and_producers(self):
+        self.queue.maxsize = 2
+        results = []
+
+        def consumer():
+            results.append(self.queue.get(timeout=10))
+
+        def producer(i):
+            self.queue.put(i, timeout=10)
+
+        consumers = [threading.Thread(target=consumer) for _ in range(16)]
+        for thread in consumers:
+            thread.start()
+        time.sleep(0.1)
+
+        # Only two producers fit at a time, every item wakes up one consumer
+        producers = [threading.Thread(target=producer, args=(i,)) for i in range(16)]
+        for thread in producers:
+            thread.start()
+        for thread in producers + consumers:
+            thread.join(10)
+
+        assert sorted(results) == list(range(16))
+        assert len(self.queue) == 0
+
+        start = time.time()
+        with pytest.raises(queue.Empty):
+            self.queue.get(timeout=0.1)
+        assert time.time() - start < 5
+
+    def test_timeouts_behind_blocked_calls(self):
+        def timed(func, *args, **kwargs):
+            start = time.time()
+            with pytest.raises((queue.Empty, queue.Full)):
+                func(*args, **kwargs)
+            return time.time() - start
+
+        # A get() blocked without timeout does not hold up a timed one
+        consumer = threading.Thread(target=self.queue.get)
+        consumer.start()
+        time.sleep(0.1)
+        assert timed(self.queue.get, timeout=0.3) < 2
+        assert timed(self.queue.peek, block=True, timeout=0.3) < 2
+
+        self.queue.put(1)
+        consumer.join(5)
+        assert not consumer.is_alive()
+
+        # The same for put() on a full queue
+        self.queue.maxsize = 1
+        self.queue.put(1)
+        producer = threading.Thread(target=self.queue.put, args=(2,))
+        producer.start()
+        time.sleep(0.1)
+        assert timed(self.queue.put, 3, timeout=0.3) < 2
+
+        assert self.queue.get() == 1
+        producer.join(5)
+        assert not producer.is_alive()
+        assert self.queue.get() == 2
+
+    def test_max_bytes(self):
+        item = os.urandom(5000)
+        self.queue.put(item)
+        with self.queue._file_lock:
+            size = self.queue._bytes()[0]
+
+        self.queue.max_bytes = size * 2 + size // 2
+        self.queue.put(item)
+
+        with pytest.raises(queue.Full):
+            self.queue.put(item, block=False)
+        with pytest.raises(queue.Full):
+            self.queue.put(item, timeout=0.05)
+
+        thread = threading.Thread(target=self.queue.put, args=(item,))
+        thread.start()
+        time.sleep(0.05)
+        assert len(self.queue) == 2
+
+        self.queue.get()
+        thread.join(5)
+        assert len(self.queue) == 2
+
+        # Items bigger than max_bytes still fit into an empty queue
+        self.queue.get(items=2)
+        self.queue.put(item * 3)
+        assert self.queue.get() == item * 3
+
+    def test_max_file_bytes(self):
+        item = os.urandom(5000)
+        self.queue.put(item)
+        with self.queue._file_lock:
+            size = self.queue._bytes()[1]
+
+        self.queue.max_file_bytes = size * 2 + size // 2
+        self.queue.put(item)
+        self.queue.get(items=2)
+
+        # Only compacting makes room
+        with pytest.raises(queue.Full):
+            self.queue.put(item, block=False)
+
+        thread = threading.Thread(target=self.queue.put, args=(item,))
+        thread.start()
+        time.sleep(0.05)
+        assert len(self.queue) == 0
+
+        self.queue.compact()
+        thread.join(5)
+        assert self.queue.get() == item
+
+    def test_max_file_bytes_flush(self):
+        item = os.urandom(5000)
+        self.queue.put(item)
+        with self.queue._file_lock:
+            size = self.queue._bytes()[1]
+
+        # Far less than the default flush_limit
+        self.queue.max_file_bytes = size * 2 + size // 2
+        self.queue.put(item)
+        self.queue.get(items=2)
+        with pytest.raises(queue.Full):
+            self.queue.put(item, block=False)
+
+        self.queue.flush()
+        self.queue.put(item, block=False)
+        assert self.queue.get() == item
+
+    def test_bytes(self):
+        numbers = array.array('i', range(10))
+        self.queue.put_bytes([b'first', bytearray(b'second'), memoryview(b'xthirdx')[1:-1], numbers])
+        self.queue.put_bytes(b'')
+        self.queue.put(b'pickled')
+
+        assert self.queue.peek_bytes() == b'first'
+        assert self.queue.peek_bytes(items=2, offset=1) == [b'second', b'third']
+
+        data = self.queue.get_bytes(items=3)
+        assert all(isinstance(view, memoryview) for view in data)
+        assert [bytes(view) for view in data] == [b'first', b'second', b'third']
+
+        assert self.queue.get_bytes() == numbers.tobytes()
+        assert self.queue.get_bytes() == b''
+        assert self.queue.loads(self.queue.get_bytes()) == b'pickled'
+
+        with pytest.raises(queue.Empty):
+            self.queue.get_bytes(block=False)
+
+    @pytest.mark.skipif(not hasattr(os, 'writev'), reason='os.writev is not available')
+    def test_writev(self, monkeypatch):
+        calls = []
+        name = 'pwritev' if hasattr(os, 'pwritev') else 'writev'
+        writev = getattr(os, name)
+
+        def counting_writev(fd, buffers, *args):
+            calls.append(len(buffers))
+            return writev(fd, buffers, *args)
+
+        monkeypatch.setattr(os, name, counting_writev)
+        monkeypatch.setattr(storage_module, 'IOV_MAX', 7)
+
+        items = [('item %d' % i).encode() for i in range(10)]
+        self.queue.put_bytes(items)
+        assert calls and max(calls) <= 7
+        assert self.queue.get_bytes(items=10) == items
+
+    @pytest.mark.skipif(not storage_module.POSITIONAL_IO, reason='os.pread is not available')
+    def test_failed_write(self, monkeypatch):
+        self.queue.put([1, 2])
+
+        def no_space(*args):
+            raise OSError(errno.ENOSPC, 'No space left on device')
+
+        monkeypatch.setattr(storage_module.os, 'pwritev', no_space)
+        with pytest.raises(OSError):
+            self.queue.put([3, 4])
+        monkeypatch.undo()
+
+        # The index has no trace of the failed put
+        assert len(self.queue) == 2
+        self.queue.put([3, 4])
+        assert self.queue.get(items=4) == [1, 2, 3, 4]
+
+    def test_put_while_reading(self, monkeypatch):
+        self.queue.put(1)
+
+        reading = threading.Event()
+        release = threading.Event()
+        read = self.queue._storage.read
+
+        def slow_read(start, end):
+            reading.set()
+            release.wait(10)
+            return read(start, end)
+
+        monkeypatch.setattr(self.queue._storage, 'read', slow_read)
+
+        results = []
+        consumer = threading.Thread(target=lambda: results.append(self.queue.get()))
+        consumer.start()
+        assert reading.wait(10)
+
+        # The record is read without the file lock, so a put goes through
+        start = time.time()
+        self.queue.put(2)
+        assert time.time() - start < 5
+
+        release.set()
+        consumer.join(10)
+        assert results == [1]
+        assert self.queue.get() == 2
+
+    def test_metrics(self):
+        self.queue.metrics = Metrics()
+
+        self.queue.put([1, 2, 3])
+        self.queue.put_bytes(self.queue.dumps(4))
+        assert self.queue.peek(items=2) == [1, 2]
+        assert self.queue.get(items=2) == [1, 2]
+        self.queue.delete()
+        assert self.queue.get(timeout=5) == 4
+
+        snapshot = self.queue.metrics.snapshot()
+        assert snapshot['put.total']['count'] == 2
+        assert snapshot['get.total']['count'] == 2
+        assert snapshot['peek.total']['count'] == 1
+        assert snapshot['delete.total']['count'] == 1
+        for name in ('put.serialize', 'put.lock_wait', 'put.write', 'get.lock_wait', 'get.read',
+                     'get.deserialize', 'peek.read'):
+            assert snapshot[name]['count'] > 0
+            assert 0 <= snapshot[name]['p50'] <= snapshot[name]['p99'] <= snapshot[name]['max']
+            assert sum(count for _, count in snapshot[name]['buckets']) == snapshot[name]['count']
+
+        if self.queue.durability == 'always':
+            assert snapshot['fsync']['count'] >= 4
+
+        self.queue.metrics.reset()
+        assert self.queue.metrics.snapshot() == {}
+
+    def test_gauges(self):
+        assert self.queue.gauges()['depth'] == 0
+
+        for i in range(10):
+            self.queue.put([os.urandom(100)])
+        gauges = self.queue.gauges()
+        assert gauges['depth'] == 10
+        assert gauges['live_bytes'] >= 1000
+        assert gauges['dead_bytes'] == 0
+        assert gauges['file_bytes'] == gauges['live_bytes']
+
+        self.queue.get(items=4)
+        removed = self.queue.gauges()
+        assert removed['depth'] == 6
+        assert removed['dead_bytes'] > 0
+        assert removed['live_bytes'] + removed['dead_bytes'] == gauges['file_bytes']
+
     def test_get_non_blocking_no_values(self):
         with pytest.raises(queue.Empty):
             assert self.queue.get(block=False, items=5) == []
@@ -236,7 +592,7 @@ class TestPersistentQueue:
         assert self.queue.get() == new_queue.get()
         assert self.queue.get() == new_queue.get()
 
-        os.remove(new_queue_name)
+        remove_queue(new_queue_name)
 
     def test_delete(self):
         self.queue.put(2)
@@ -258,6 +614,685 @@ class TestPersistentQueue:
         self.queue.delete(0)
         assert len(self.queue) == 1
 
+    def test_records_across_chunks(self):
+        small = b'x' * 100
+        large = b'y' * (pq_module.READ_CHUNK_SIZE * 2 + 7)
+
+        items = [small, large] * 20 + [small] * 2000
+        self.queue.put(items)
+
+        assert self.queue.peek(items=3) == [small, large, small]
+        assert self.queue.get(items=41) == items[:41]
+
+        reopened = PersistentQueue(self.queue.filename,
+                                   loads=self.queue.loads,
+                                   use_mmap=self.queue.use_mmap,
+                                   segment_size=self.queue.segment_size,
+                                   compression=self.queue.compression,
+                                   compress_batches=self.queue.compress_batches)
+        assert len(reopened) == 1999
+        assert reopened.peek(items=2, offset=1998) == [small]
+
+        self.queue.delete(1000)
+        assert self.queue.get(items=999) == items[1041:]
+        assert len(self.queue) == 0
+
+    def test_peek_offset(self):
+        self.queue.put(list(range(10)))
+
+        assert self.queue.peek(offset=3) == 3
+        assert self.queue.peek(items=3, offset=8) == [8, 9]
+        assert self.queue.peek(items=3, offset=10) == []
+        assert self.queue.peek(offset=42) is None
+
+        self.queue.delete(5)
+        assert self.queue.peek(items=2, offset=3) == [8, 9]
+
+        with pytest.raises(queue.Empty):
+            self.queue.peek(block=True, timeout=0.1, items=2, offset=4)
+
+        self.queue.put(10)
+        assert self.queue.peek(block=True, items=2, offset=4) == [9, 10]
+
+    def test_peek_cache(self, monkeypatch):
+        self.queue._peek_cache = pq_module._PeekCache(20)
+        self.queue.put(list(range(30)))
+
+        loaded = []
+        reads = []
+        loads = self.queue.loads
+        read = self.queue._storage.read
+
+        def counting_loads(payload):
+            loaded.append(payload)
+            return loads(payload)
+
+        def counting_read(start, end):
+            reads.append(start)
+            return read(start, end)
+
+        monkeypatch.setattr(self.queue, 'loads', counting_loads)
+        monkeypatch.setattr(self.queue._storage, 'read', counting_read)
+
+        assert self.queue.peek(items=10) == list(range(10))
+        assert len(loaded) == 10
+        reads[:] = []
+
+        # Served without reading or deserializing anything
+        assert self.queue.peek(items=10) == list(range(10))
+        assert self.queue.peek(items=5, offset=2) == list(range(2, 7))
+        assert self.queue.peek() == 0
+        assert len(loaded) == 10
+        assert reads == []
+
+        # Removed items are gone from the cache
+        assert self.queue.get(items=2) == [0, 1]
+        assert self.queue.peek(items=8) == list(range(2, 10))
+        assert len(loaded) == 12
+        assert self.queue.peek(items=9) == list(range(2, 11))
+        assert len(loaded) == 21
+
+        # Batches larger than the cache are not kept
+        assert self.queue.peek(items=25) == list(range(2, 27))
+        assert self.queue.peek(items=25) == list(range(2, 27))
+        assert len(loaded) == 71
+
+        self.queue.clear()
+        self.queue.put([100, 101])
+        assert self.queue.peek(items=2) == [100, 101]
+        assert len(loaded) == 73
+
+        stats = self.queue.peek_cache_stats()
+        assert stats['hits'] == 4
+        assert stats['misses'] == 5
+        assert stats['items'] == 2
+
+    def test_peek_cache_bytes(self):
+        self.queue._peek_cache = pq_module._PeekCache(max_bytes=10000)
+        assert self.queue.peek_cache_stats()['bytes'] == 0
+
+        items = [os.urandom(1000) for _ in range(20)]
+        self.queue.put(items)
+        assert self.queue.peek(items=5) == items[:5]
+        assert self.queue.peek(items=5) == items[:5]
+
+        stats = self.queue.peek_cache_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['items'] == 5
+        assert 5000 < stats['bytes'] < 6000
+
+        # Only the most recently peeked items stay within the bound
+        assert self.queue.peek(items=6, offset=5) == items[5:11]
+        stats = self.queue.peek_cache_stats()
+        assert stats['items'] == 9
+        assert stats['evictions'] == 2
+        assert stats['bytes'] <= 10000
+        assert self.queue.peek(items=2) == items[:2]
+        assert self.queue.peek_cache_stats()['misses'] == 3
+
+        # Nor are batches bigger than the cache kept
+        assert self.queue.peek(items=11) == items[:11]
+        assert self.queue.peek(items=11) == items[:11]
+        assert self.queue.peek_cache_stats()['hits'] == 1
+
+        self.queue.delete(20)
+        assert self.queue.peek_cache_stats()['items'] == 0
+        assert self.queue.peek_cache_stats()['bytes'] == 0
+
+    def test_index_after_flush(self):
+        self.queue.flush_limit = 0
+        self.queue.put(list(range(100)))
+        self.queue.delete(40)
+        self.queue.flush()
+
+        assert len(self.queue) == 60
+        assert self.queue.peek(items=2, offset=50) == [90, 91]
+
+        self.queue.put(100)
+        assert self.queue.get(items=61) == list(range(40, 101))
+
+    def test_upgrade_legacy_file(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        # Format of version 1.3.0: 32-bit length and top, 32-bit record lengths
+        items = [self.queue.dumps(i) for i in [b'gone', 1, b'two', {b'three': 3}]]
+        with open(filename, 'wb') as legacy:
+            top = 8 + 4 + len(items[0])
+            legacy.write(struct.pack('II', len(items) - 1, top))
+            for data in items:
+                legacy.write(struct.pack('I', len(data)))
+                legacy.write(data)
+
+        q = PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+        assert len(q) == 3
+        assert q.peek(items=3) == [1, b'two', {b'three': 3}]
+
+        with open(filename, 'rb') as upgraded:
+            assert upgraded.read(6) == b'PQUE' + struct.pack('<H', storage_module.FORMAT_VERSION)
+
+        q.put(4)
+        q = PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+        assert q.get(items=4) == [1, b'two', {b'three': 3}, 4]
+
+        os.remove(filename)
+
+    def test_upgrade_legacy_file_in_chunks(self, monkeypatch):
+        monkeypatch.setattr(pq_module, 'UPGRADE_CHUNK_SIZE', 1000)
+
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        items = [self.queue.dumps(['x' * 90, i]) for i in range(100)]
+        with open(filename, 'wb') as legacy:
+            legacy.write(struct.pack('II', len(items), 8))
+            for data in items:
+                legacy.write(struct.pack('I', len(data)))
+                legacy.write(data)
+
+        writes = []
+        writev = storage_module.FileStorage.writev
+
+        def counting_writev(storage, pos, buffers):
+            writes.append(sum(len(buf) for buf in buffers))
+            writev(storage, pos, buffers)
+
+        monkeypatch.setattr(storage_module.FileStorage, 'writev', counting_writev)
+
+        # The records are streamed in chunks instead of being written at once
+        q = PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+        assert len(writes) > 5
+        assert max(writes) < 2000
+        assert q.get(items=100) == [['x' * 90, i] for i in range(100)]
+
+        os.remove(filename)
+
+    def test_newer_format(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        with open(filename, 'wb') as newer:
+            newer.write(storage_module.pack_header(0, storage_module.START_OFFSET))
+            newer.seek(4)
+            newer.write(struct.pack('<H', 999))
+
+        with pytest.raises(IOError):
+            PersistentQueue(filename)
+
+        os.remove(filename)
+
+    def test_recovery(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        def open_queue():
+            return PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+
+        def write_length(length):
+            storage = storage_module.FileStorage(filename)
+            storage.write_length(length)
+            storage.close()
+
+        items = [('item %d' % i).encode() for i in range(10)]
+
+        q = open_queue()
+        q.put(items)
+        size = os.path.getsize(filename)
+
+        # A record cut off at the end of the file
+        with open(filename, 'ab') as file:
+            file.write(struct.pack(pq_module.RECORD_STRUCT, 1000, 0) + b'torn')
+
+        q = open_queue()
+        assert len(q) == 10
+        assert os.path.getsize(filename) == size
+
+        # The file grew but the records never made it to disk
+        with open(filename, 'ab') as file:
+            file.write(b'\0' * 4096)
+
+        q = open_queue()
+        assert len(q) == 10
+        assert os.path.getsize(filename) == size
+
+        # The length was written but not all of the records
+        write_length(12)
+        assert len(open_queue()) == 10
+
+        # The records were written but not the length, they were never
+        # committed
+        write_length(8)
+        q = open_queue()
+        assert len(q) == 8
+        assert q.get(items=8) == items[:8]
+
+        # Empty records are not mistaken for zeros
+        q.put_bytes([b'', b''])
+        q = open_queue()
+        assert q.get_bytes(items=2) == [b'', b'']
+
+        # A corrupt record is removed along with everything after it
+        q.put(items)
+        with open(filename, 'r+b') as file:
+            file.seek(-3, os.SEEK_END)
+            file.write(b'!')
+
+        with pytest.raises(IOError):
+            q.peek(items=10)
+
+        q = open_queue()
+        assert len(q) == 9
+        assert q.get(items=9) == items[:9]
+
+        os.remove(filename)
+
+    def test_recovery_mid_file_corruption(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        def open_queue():
+            return PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+
+        def corrupt(index):
+            with open(filename, 'r+b') as file:
+                file.seek(q._offsets[q._head + index] + pq_module.RECORD_HEADER_SIZE + 2)
+                data = file.read(1)
+                file.seek(-1, os.SEEK_CUR)
+                file.write(bytes([data[0] ^ 0xff]))
+
+        q = open_queue()
+        q.put([('item %d' % i).encode() for i in range(100)])
+        size = os.path.getsize(filename)
+
+        # The committed records after it are not thrown away
+        corrupt(0)
+        with pytest.raises(IOError):
+            open_queue()
+        assert os.path.getsize(filename) == size
+
+        # Records the header does not count yet were never committed, damage
+        # to them is a crash's doing
+        remove_queue(filename)
+        q = open_queue()
+        q.put([('item %d' % i).encode() for i in range(100)])
+        storage = storage_module.FileStorage(filename)
+        storage.write_length(50)
+        storage.close()
+        corrupt(60)
+
+        q = open_queue()
+        assert len(q) == 50
+        assert q.get(items=50) == [('item %d' % i).encode() for i in range(50)]
+
+        os.remove(filename)
+
+    def test_torn_header(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+
+        def open_queue():
+            return PersistentQueue(filename, dumps=self.queue.dumps, loads=self.queue.loads)
+
+        def tear_slot(seq):
+            with open(filename, 'r+b') as file:
+                file.seek(storage_module.SLOT_OFFSETS[seq % 2] + 4)
+                file.write(b'!')
+
+        q = open_queue()
+        q.put(list(range(10)))
+        q.get(items=3)
+        assert q._storage._state[0] == 2
+
+        # Only the last state is lost, the other slot still has the one before
+        tear_slot(2)
+        q = open_queue()
+        assert len(q) == 10
+        assert q.get() == 0
+
+        # Commits go on from the state that was read
+        assert q._storage._state[0] == 2
+        assert len(open_queue()) == 9
+
+        tear_slot(1)
+        tear_slot(2)
+        with pytest.raises(IOError):
+            open_queue()
+
+        os.remove(filename)
+
+    def test_consume(self):
+        self.queue.put(list(range(250)))
+
+        batches = list(self.queue.consume(batch_size=100, max_wait=0.1))
+        assert batches == [list(range(100)), list(range(100, 200)), list(range(200, 250))]
+        assert self.queue.empty()
+
+        # Batches are only acknowledged when the next one is asked for
+        self.queue.put(list(range(250)))
+        for batch in self.queue.consume(batch_size=100, max_wait=0.1, prefetch=2):
+            break
+        assert len(self.queue) == 250
+
+        # A queue.Queue with maxsize=0 would read the whole queue ahead
+        with pytest.raises(ValueError):
+            next(self.queue.consume(prefetch=0))
+
+        consumer = self.queue.consume(batch_size=100, max_wait=0.1)
+        assert next(consumer) == list(range(100))
+        assert next(consumer) == list(range(100, 200))
+        consumer.close()
+        assert len(self.queue) == 150
+        assert self.queue.peek() == 100
+
+    def test_consume_waits_for_batches(self):
+        def producer():
+            for i in range(10):
+                time.sleep(0.01)
+                self.queue.put(list(range(i * 10, i * 10 + 10)))
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+
+        items = []
+        for batch in self.queue.consume(batch_size=25, max_wait=1):
+            assert len(batch) == 25
+            items.extend(batch)
+            if len(items) == 100:
+                break
+
+        thread.join()
+        assert items == list(range(100))
+
+    def test_consume_loads_without_lock(self):
+        self.queue.put(list(range(10)))
+        loading = threading.Event()
+        release = threading.Event()
+
+        def slow_loads(data):
+            loading.set()
+            release.wait(5)
+            return self.queue.loads(data)
+
+        q = PersistentQueue(self.queue.filename, dumps=self.queue.dumps, loads=slow_loads,
+                            use_mmap=self.queue.use_mmap, segment_size=self.queue.segment_size,
+                            multiprocess=self.queue.multiprocess, compression=self.queue.compression,
+                            compress_batches=self.queue.compress_batches)
+        consumer = q.consume(batch_size=5)
+        thread = threading.Thread(target=next, args=(consumer,))
+        thread.start()
+        assert loading.wait(5)
+
+        # A put goes through while the prefetched batch is deserialized
+        start = time.time()
+        q.put(10)
+        assert time.time() - start < 1
+        release.set()
+        thread.join(5)
+        consumer.close()
+        assert len(q) == 11
+
+    def test_loads_executor(self):
+        futures = pytest.importorskip('concurrent.futures')
+
+        expected = list(range(1000))
+        self.queue.put(expected)
+
+        for executor in (futures.ThreadPoolExecutor(max_workers=4),
+                         futures.ProcessPoolExecutor(max_workers=2)):
+            self.queue.loads_executor = executor
+            assert self.queue.peek(items=1000) == expected
+            assert self.queue.get(items=300) == expected[:300]
+            self.queue.put(expected[:300])
+            expected = expected[300:] + expected[:300]
+            executor.shutdown()
+
+        self.queue.loads_executor = None
+        assert self.queue.get(items=1000) == expected
+
+    def test_compact(self, monkeypatch):
+        monkeypatch.setattr(pq_module, 'COMPACT_STEP_SIZE', 1000)
+
+        items = [['x' * 100, i] for i in range(1000)]
+        for item in items:
+            self.queue.put([item])
+        assert self.queue.get(items=900) == items[:900]
+
+        # Items keep coming while the data is copied
+        def producer():
+            for i in range(100):
+                self.queue.put([['y', i]])
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        self.queue.compact()
+        thread.join()
+
+        stats = self.queue.compaction_stats()
+        assert stats['compactions'] == 1
+        assert stats['bytes_reclaimed'] > 0
+        assert stats['max_pause_seconds'] == stats['pause_seconds']
+
+        assert self.queue.get(items=200) == items[900:] + [['y', i] for i in range(100)]
+
+    @pytest.mark.parametrize('copier', ['_sendfile', '_read_write'])
+    def test_compact_copiers(self, monkeypatch, copier):
+        if copier == '_sendfile' and not hasattr(os, 'sendfile'):
+            pytest.skip('os.sendfile is not available')
+
+        monkeypatch.setattr(storage_module, 'COPIERS', [getattr(storage_module, copier)])
+        monkeypatch.setattr(storage_module, 'COPY_BUFFER_SIZE', 100)
+
+        items = [['x' * 100, i] for i in range(100)]
+        for item in items:
+            self.queue.put([item])
+        self.queue.get(items=50)
+        self.queue.compact()
+
+        stats = self.queue.compaction_stats()
+        if stats['compactions'] and not isinstance(self.queue._storage, storage_module.SegmentedStorage):
+            assert stats['bytes_copied'] > 0
+        assert self.queue.get(items=50) == items[50:]
+
+    def test_auto_compact(self, monkeypatch):
+        monkeypatch.setattr(pq_module, 'COMPACT_CHECK_INTERVAL', 0.01)
+
+        self.queue.flush_limit = 0
+        self.queue.compact_ratio = 0.5
+        compactor = pq_module._Compactor(self.queue)
+
+        for i in range(100):
+            self.queue.put(b'x' * 100)
+        self.queue.get(items=10)
+        time.sleep(0.1)
+        assert self.queue.compaction_stats()['compactions'] == 0
+
+        self.queue.get(items=60)
+        for _ in range(500):
+            if self.queue.compaction_stats()['compactions']:
+                break
+            time.sleep(0.01)
+
+        assert self.queue.compaction_stats()['compactions'] == 1
+        assert self.queue.get(items=30) == [b'x' * 100] * 30
+        compactor.stop()
+
+    def test_close_stops_compactor(self, monkeypatch):
+        monkeypatch.setattr(pq_module, 'COMPACT_CHECK_INTERVAL', 0.01)
+
+        q = PersistentQueue(self.queue.filename,
+                            dumps=self.queue.dumps,
+                            loads=self.queue.loads,
+                            segment_size=self.queue.segment_size,
+                            auto_compact=True)
+        thread = q._compactor._thread
+        assert thread.is_alive()
+
+        q.close()
+        assert not thread.is_alive()
+        assert q._compactor is None
+
+    def reopen_with_options(self):
+        return PersistentQueue(self.queue.filename,
+                               dumps=self.queue.dumps,
+                               loads=self.queue.loads,
+                               use_mmap=self.queue.use_mmap,
+                               segment_size=self.queue.segment_size,
+                               compression=self.queue.compression,
+                               compress_batches=self.queue.compress_batches)
+
+    def test_close(self):
+        if not os.path.isdir('/proc/self/fd'):
+            pytest.skip('Counting open files needs /proc')
+
+        self.queue.put(1)
+        before = len(os.listdir('/proc/self/fd'))
+
+        for _ in range(20):
+            with PersistentQueue(self.queue.filename,
+                                 dumps=self.queue.dumps,
+                                 loads=self.queue.loads,
+                                 use_mmap=self.queue.use_mmap,
+                                 segment_size=self.queue.segment_size,
+                                 multiprocess=self.queue.multiprocess,
+                                 compression=self.queue.compression,
+                                 compress_batches=self.queue.compress_batches) as q:
+                q.put(2)
+                assert q.get(items=2) == [1, 2]
+                q.put(1)
+
+        assert len(os.listdir('/proc/self/fd')) == before
+
+    def test_lease(self):
+        self.queue.put([1, 2, 3, 4, 5])
+
+        first, data = self.queue.lease(items=2)
+        assert data == [1, 2]
+        second, data = self.queue.lease()
+        assert data == 3
+        assert first != second
+        assert len(self.queue) == 2
+
+        self.queue.ack(first)
+        self.queue.nack(second)
+        assert self.queue.get(items=3) == [4, 5, 3]
+
+        with pytest.raises(ValueError):
+            self.queue.ack(first)
+
+        with pytest.raises(queue.Empty):
+            self.queue.lease(block=False)
+
+    def test_lease_expiry(self):
+        self.queue.put([1, 2, 3])
+
+        expiring, data = self.queue.lease(visibility_timeout=0.05)
+        assert data == 1
+        assert self.queue.lease(items=2)[1] == [2, 3]
+
+        # The blocked lease gets the redelivered item
+        lease_id, data = self.queue.lease(timeout=5)
+        assert data == 1
+        with pytest.raises(ValueError):
+            self.queue.ack(expiring)
+        self.queue.ack(lease_id)
+
+    def test_lease_expiry_wakes_get(self):
+        self.queue.put(1)
+        expiring, _ = self.queue.lease(visibility_timeout=0.1)
+
+        # Nothing calls lease() again, the blocked get() is woken up anyway
+        assert self.queue.get(timeout=5) == 1
+        with pytest.raises(ValueError):
+            self.queue.ack(expiring)
+
+        self.queue.put(2)
+        self.queue.lease(visibility_timeout=0.05)
+        time.sleep(0.2)
+        assert self.queue.get(block=False) == 2
+
+    def test_lease_expiry_with_blocked_producer(self):
+        self.queue.maxsize = 2
+        self.queue.put([1, 2])
+        self.queue.lease(visibility_timeout=0.05)
+        self.queue.put(3)
+
+        # The producer waits for room holding _put_lock
+        producer = threading.Thread(target=self.queue.put, args=(4,), kwargs={'timeout': 5})
+        producer.start()
+        time.sleep(0.1)
+
+        result = []
+        consumer = threading.Thread(target=lambda: result.append(self.queue.lease(items=2, timeout=5)[1]))
+        consumer.start()
+        consumer.join(5)
+        producer.join(5)
+
+        assert result == [[2, 3]]
+        assert self.queue.get(items=2, timeout=5) == [1, 4]
+
+    def test_lease_restart(self, monkeypatch):
+        monkeypatch.setattr(leases_module, 'REWRITE_LIMIT', 100)
+
+        self.queue.put([[i, 'x' * 50] for i in range(20)])
+        for _ in range(5):
+            self.queue.ack(self.queue.lease(items=2)[0])
+        kept, _ = self.queue.lease(items=2)
+        expiring, _ = self.queue.lease(visibility_timeout=0.01)
+        time.sleep(0.02)
+
+        q = self.reopen_with_options()
+        assert len(q) == 8
+        assert q.peek(offset=7) == [12, 'x' * 50]
+
+        q.ack(kept)
+        assert q.lease()[0] > expiring
+        assert q._leases.next_deadline() is not None
+        assert os.path.getsize(self.queue.filename + '.inflight') < 1000
+
+    def test_lease_broken_log(self):
+        self.queue.put(list(range(3)))
+        lease_id, _ = self.queue.lease()
+        size = os.path.getsize(self.queue.filename + '.inflight')
+
+        # Zeros, then an entry too short to hold a lease with a valid CRC32
+        with open(self.queue.filename + '.inflight', 'ab') as file:
+            file.write(b'\0' * 100)
+        q = self.reopen_with_options()
+        assert list(q._leases.leases) == [lease_id]
+        assert os.path.getsize(self.queue.filename + '.inflight') == size
+
+        q.close()
+        size_field = struct.pack(leases_module.ENTRY_SIZE_STRUCT, 1)
+        with open(self.queue.filename + '.inflight', 'ab') as file:
+            file.write(size_field + struct.pack('<I', leases_module._crc(size_field, b'!')) + b'!')
+        q = self.reopen_with_options()
+        assert list(q._leases.leases) == [lease_id]
+        assert os.path.getsize(self.queue.filename + '.inflight') == size
+
+        q.ack(lease_id)
+        assert q.get(items=2) == [1, 2]
+
+    def test_lease_rewrite_keeps_newest(self, monkeypatch):
+        monkeypatch.setattr(leases_module, 'REWRITE_LIMIT', 100)
+
+        self.queue.put([[i, 'x' * 50] for i in range(10)])
+        leased = [self.queue.lease()[0] for _ in range(10)]
+
+        # The log is rewritten while the newest lease is still open
+        for lease_id in leased[:9]:
+            self.queue.ack(lease_id)
+        assert os.path.getsize(self.queue.filename + '.inflight') < 1000
+
+        q = self.reopen_with_options()
+        assert list(q._leases.leases) == [leased[9]]
+        assert len(q) == 0
+
+        q.nack(leased[9])
+        assert q.get() == [9, 'x' * 50]
+        q.put(1)
+        assert q.lease()[0] > leased[9]
+
     def test_delete_no_values(self):
         self.queue.delete()
         self.queue.delete(100)
@@ -377,3 +1412,277 @@ class TestPersistentQueueWithMsgpack(TestPersistentQueue):
         self.queue = PersistentQueue(filename,
                                      loads=msgpack.unpackb,
                                      dumps=msgpack.packb)
+
+
+class TestPersistentQueueWithMmap(TestPersistentQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}'.format(self.__class__.__name__, random)
+        self.queue = PersistentQueue(filename, use_mmap=True)
+
+
+class TestPersistentQueueWithSegments(TestPersistentQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}'.format(self.__class__.__name__, random)
+        self.queue = PersistentQueue(filename, segment_size=4096)
+
+    def test_put_fsyncs_once(self, monkeypatch):
+        calls = []
+
+        def counting(sync):
+            def counting_sync(fd):
+                calls.append(fd)
+                sync(fd)
+            return counting_sync
+
+        monkeypatch.setattr(storage_module.os, 'fsync', counting(os.fsync))
+        if hasattr(os, 'fdatasync'):
+            monkeypatch.setattr(storage_module.os, 'fdatasync', counting(os.fdatasync))
+
+        # The segment, the manifest and the directory the segment was created in
+        self.queue.put(list(range(1000)))
+        assert len(calls) == 3
+        assert len(self.queue) == 1000
+
+        # Only the manifest
+        self.queue.get(items=500)
+        assert len(calls) == 4
+
+    def test_segments(self):
+        def segments():
+            return sorted(name for name in os.listdir(self.queue.filename)
+                          if name.endswith('.segment'))
+
+        self.queue.flush_limit = 0
+        for i in range(100):
+            self.queue.put(b'x' * 900)
+
+        assert len(segments()) == 25
+
+        self.queue.delete(50)
+        self.queue.flush()
+        assert len(segments()) == 13
+        assert len(self.queue) == 50
+
+        reopened = PersistentQueue(self.queue.filename, segment_size=4096, flush_limit=0)
+        assert len(reopened) == 50
+        assert reopened.get(items=50) == [b'x' * 900] * 50
+        reopened.flush()
+        assert len(segments()) == 1
+
+        reopened.clear()
+        reopened.put(b'y')
+        assert PersistentQueue(self.queue.filename, segment_size=4096).get() == b'y'
+
+
+class TestPersistentQueueWithCompression(TestPersistentQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.queue = PersistentQueue(filename, compression='zlib')
+
+    def test_compression_recorded(self):
+        with pytest.raises(ValueError):
+            PersistentQueue(self.queue.filename + '-other', compression='snappy')
+
+        self.queue.put([{'key': 'value' * 100}] * 100)
+        assert os.path.getsize(self.queue.filename) < 100 * 500
+
+        # The file says how it is compressed
+        with pytest.raises(ValueError):
+            PersistentQueue(self.queue.filename)
+        with pytest.raises(ValueError):
+            PersistentQueue(self.queue.filename, compression='zlib', compress_batches=True)
+
+        # An empty queue can switch
+        self.queue.delete(100)
+        q = PersistentQueue(self.queue.filename)
+        q.put('a')
+        assert q.get() == 'a'
+
+        header = open(self.queue.filename, 'rb').read(8)
+        with open(self.queue.filename, 'r+b') as file:
+            file.write(header[:6] + struct.pack('<H', 200))
+
+        with pytest.raises(IOError):
+            PersistentQueue(self.queue.filename)
+
+
+class TestPersistentQueueWithBlockCompression(TestPersistentQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.queue = PersistentQueue(filename, compression='zlib', compress_batches=True)
+
+    def reopen(self):
+        return PersistentQueue(self.queue.filename, compression='zlib', compress_batches=True,
+                               flush_limit=0, dumps=self.queue.dumps, loads=self.queue.loads)
+
+    def test_blocks(self, monkeypatch):
+        monkeypatch.setattr(pq_module, 'BLOCK_SIZE', 1000)
+
+        items = [{'id': i, 'data': 'x' * 100} for i in range(1000)]
+        self.queue.put(items)
+        assert os.path.getsize(self.queue.filename) < 1000 * 100 / 2
+
+        # Removing part of a block is kept across reopening
+        assert self.queue.get(items=5) == items[:5]
+        q = self.reopen()
+        assert len(q) == 995
+        assert q.peek(items=3) == items[5:8]
+
+        q.delete(100)
+        assert q.peek(items=20, offset=50) == items[155:175]
+
+        q.flush()
+        assert self.reopen().peek(items=845) == items[105:950]
+        assert q.get(items=50) == items[105:155]
+
+        q.put(items[:10])
+        q.flush()
+        q = self.reopen()
+        assert q.get(items=855) == items[155:] + items[:10]
+        assert q.empty()
+
+    def test_last_block_kept(self, monkeypatch):
+        decompress = self.queue._codec.decompress
+        calls = []
+
+        def counting(data):
+            calls.append(len(data))
+            return decompress(data)
+
+        monkeypatch.setattr(self.queue._codec, 'decompress', counting)
+
+        items = [{'id': i, 'data': 'x' * 100} for i in range(100)]
+        self.queue.put(items[:50])
+        self.queue.put(items[50:])
+        assert [self.queue.get() for _ in range(50)] == items[:50]
+        assert len(calls) == 1
+        assert self.queue.peek(items=2) == items[50:52]
+        assert self.queue.get() == items[50]
+        assert len(calls) == 2
+
+        # The block moves, and another one takes its place
+        self.queue.flush_limit = 0
+        self.queue.flush()
+        assert self.queue.get() == items[51]
+        self.queue.clear()
+        self.queue.put(items[::-1])
+        assert self.queue.get() == items[99]
+        assert len(calls) == 4
+
+
+def produce(filename, count):
+    q = PersistentQueue(filename, multiprocess=True)
+    for i in range(count):
+        q.put(i)
+
+
+class TestPersistentQueueMultiprocess(TestPersistentQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        filename = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.queue = PersistentQueue(filename, multiprocess=True)
+
+    def test_multiprocess_options(self):
+        with pytest.raises(ValueError):
+            PersistentQueue(self.queue.filename + '-segments', segment_size=4096, multiprocess=True)
+
+    def test_lease(self):
+        self.queue.put(1)
+        with pytest.raises(ValueError):
+            self.queue.lease()
+
+    test_lease_expiry = test_lease_expiry_with_blocked_producer = test_lease_expiry_wakes_get = test_lease
+    test_lease_restart = test_lease_broken_log = test_lease_rewrite_keeps_newest = test_lease
+
+    def test_put_while_reading(self):
+        pytest.skip('Records are read with the file lock held in multiprocess mode')
+
+    def test_shared_file(self):
+        # Separate instances don't share any state besides the file
+        other = PersistentQueue(self.queue.filename, multiprocess=True)
+
+        self.queue.put([1, 2, 3])
+        assert len(other) == 3
+        assert other.get() == 1
+        assert self.queue.peek(items=2) == [2, 3]
+
+        other.put(4)
+        assert self.queue.get(items=3) == [2, 3, 4]
+        assert other.empty()
+
+        # Compacting replaces the file under the other instance
+        self.queue.flush_limit = 0
+        other.put(list(range(100)))
+        self.queue.delete(60)
+        self.queue.flush()
+        assert other.get(items=40) == list(range(60, 100))
+
+        other.put(5)
+        self.queue.clear()
+        assert len(other) == 0
+        other.put(6)
+        assert self.queue.get() == 6
+
+    def test_wakeup_across_instances(self):
+        other = PersistentQueue(self.queue.filename, multiprocess=True, maxsize=1)
+        result = []
+
+        def consumer():
+            result.append(self.queue.get(timeout=5))
+
+        thread = threading.Thread(target=consumer)
+        thread.start()
+        time.sleep(0.1)
+        other.put('a')
+        thread.join()
+        assert result == ['a']
+
+        other.put('b')
+        with pytest.raises(queue.Full):
+            other.put('c', timeout=0.1)
+
+        def producer():
+            other.put('c', timeout=5)
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        time.sleep(0.1)
+        assert self.queue.get() == 'b'
+        thread.join()
+        assert self.queue.get() == 'c'
+
+    def test_stale_wakeups(self, monkeypatch):
+        for i in range(100):
+            self.queue.put(i)
+            self.queue.get()
+
+        refreshes = []
+        refresh = self.queue._refresh
+
+        def counting_refresh():
+            refreshes.append(time.time())
+            refresh()
+
+        monkeypatch.setattr(self.queue, '_refresh', counting_refresh)
+
+        # The wakeups left in the pipe do not make the wait spin
+        with pytest.raises(queue.Empty):
+            self.queue.get(timeout=0.5)
+        assert len(refreshes) < 10
+
+    def test_producer_process(self):
+        processes = [multiprocessing.Process(target=produce, args=(self.queue.filename, 200))
+                     for _ in range(2)]
+        for process in processes:
+            process.start()
+
+        items = self.queue.get(items=400, timeout=30)
+        for process in processes:
+            process.join()
+
+        assert sorted(items) == sorted(list(range(200)) * 2)
+        assert self.queue.empty()
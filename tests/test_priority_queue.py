@@ -0,0 +1,161 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+import pytest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from persistent_queue import PersistentPriorityQueue
+
+
+@pytest.fixture(autouse=True)
+def t(tmpdir):
+    os.chdir(str(tmpdir))
+
+
+class TestPersistentPriorityQueue:
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        self.dirname = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.options = {'lanes': 3}
+        self.queue = PersistentPriorityQueue(self.dirname, **self.options)
+
+    def teardown_method(self):
+        self.queue.close()
+        shutil.rmtree(self.dirname)
+
+    def test_lanes(self):
+        with pytest.raises(ValueError):
+            PersistentPriorityQueue(self.dirname, lanes=0)
+
+        with pytest.raises(ValueError):
+            self.queue.put(1, priority=3)
+
+        assert len(self.queue.lanes) == 3
+        assert sorted(os.listdir(self.dirname)) == ['lane0', 'lane1', 'lane2']
+
+    def test_get_by_priority(self):
+        self.queue.put([1, 2, 3], priority=2)
+        self.queue.put([4, 5], priority=1)
+        self.queue.put(6, priority=0)
+        assert len(self.queue) == 6
+
+        assert self.queue.get() == 6
+        assert self.queue.get(items=3) == [4, 5, 1]
+        self.queue.put(7, priority=0)
+        assert self.queue.get(items=3) == [7, 2, 3]
+        assert self.queue.empty()
+
+        with pytest.raises(queue.Empty):
+            self.queue.get(block=False)
+
+        with pytest.raises(queue.Empty):
+            self.queue.get(timeout=0.01)
+
+    def test_peek_delete(self):
+        self.queue.put([1, 2], priority=1)
+        self.queue.put([3, 4], priority=0)
+
+        assert self.queue.peek() == 3
+        assert self.queue.peek(items=3) == [3, 4, 1]
+        assert self.queue.peek(items=3, offset=1) == [4, 1, 2]
+        assert self.queue.peek(items=2, offset=4) == []
+
+        self.queue.delete(3)
+        assert self.queue.get() == 2
+        assert self.queue.peek() is None
+
+    def test_persistence(self):
+        self.queue.put([1, 2], priority=1)
+        self.queue.put(3, priority=0)
+        self.queue.get()
+
+        reopened = PersistentPriorityQueue(self.dirname, **self.options)
+        assert reopened.get(items=2) == [1, 2]
+
+    def test_blocking_get(self):
+        results = []
+
+        def consumer():
+            results.append(self.queue.get(items=3))
+
+        thread = threading.Thread(target=consumer)
+        thread.start()
+
+        self.queue.put(1, priority=2)
+        time.sleep(0.05)
+        assert results == []
+        self.queue.put([2, 3], priority=0)
+        thread.join(5)
+
+        assert results == [[2, 3, 1]]
+
+    def test_timeout_behind_blocked_get(self):
+        blocked = threading.Thread(target=self.queue.get, kwargs={'items': 2, 'timeout': 2})
+        blocked.start()
+        time.sleep(0.05)
+
+        # The blocked get() does not hold up the timeout of this one
+        start = time.time()
+        with pytest.raises(queue.Empty):
+            self.queue.get(timeout=0.1)
+        assert time.time() - start < 1
+
+        self.queue.put([1, 2], priority=1)
+        blocked.join(5)
+        assert not blocked.is_alive()
+        assert self.queue.empty()
+
+    def test_close(self):
+        self.queue.put(1, priority=1)
+        with PersistentPriorityQueue(self.dirname, **self.options) as reopened:
+            assert len(reopened) == 1
+        assert all(lane._storage is None for lane in reopened.lanes)
+
+    def test_shared_commit(self, monkeypatch):
+        synced = []
+        for lane in self.queue.lanes:
+            monkeypatch.setattr(lane, 'sync', lambda lane=lane: synced.append(lane))
+
+        self.queue.put([1, 2], priority=1)
+        self.queue.put(3, priority=2)
+        assert synced == [self.queue.lanes[1], self.queue.lanes[2]]
+
+        del synced[:]
+        assert self.queue.get(items=3) == [1, 2, 3]
+        assert synced == [self.queue.lanes[1], self.queue.lanes[2]]
+
+    def test_task_done(self):
+        self.queue.put([1, 2], priority=1)
+        self.queue.get(items=2)
+        self.queue.task_done(2)
+        self.queue.join()
+
+        with pytest.raises(ValueError):
+            self.queue.task_done()
+
+
+class TestPersistentPriorityQueueBatch(TestPersistentPriorityQueue):
+    def setup_method(self):
+        random = str(uuid.uuid4()).replace('-', '')
+        self.dirname = '{}_{}.queue'.format(self.__class__.__name__, random)
+        self.options = {'lanes': 3, 'durability': 'batch', 'segment_size': 1024}
+        self.queue = PersistentPriorityQueue(self.dirname, **self.options)
+
+    def test_concurrent_puts(self):
+        def producer(priority):
+            for i in range(50):
+                self.queue.put(i, priority=priority)
+
+        threads = [threading.Thread(target=producer, args=(priority,)) for priority in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert self.queue.get(items=150) == list(range(50)) * 3